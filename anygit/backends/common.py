@@ -1,14 +1,19 @@
+import collections
 import datetime
 import hashlib
 import logging
-import random
+import Queue
 import re
 import routes.util
 import subprocess
+import sys
+import threading
+import time
 import urlparse
 
 from pylons import config
 
+from anygit import memory, stats
 from anygit.data import exceptions
 
 logger = logging.getLogger(__name__)
@@ -20,6 +25,19 @@ sha1_re = re.compile('^[a-f0-9]*')
 
 pending_saves = 0
 max_pending_saves = 1000
+# Most objects to keep in the identity map
+identity_map_size = 100000
+# Whether to hand full batches of saves to a background thread to
+# write, rather than writing them inline.  flush() still waits for
+# everything to be written.
+write_behind = False
+# Most batches to have waiting to be written before saving blocks
+write_behind_batches = 2
+
+# Rows from ingest() waiting to be written, by class
+_ingested = {}
+# Association table name -> (class, whether it has a name and mode)
+_edge_kinds = None
 
 ## Exported functions
 
@@ -30,18 +48,171 @@ def flush():
     # Should replace this
     raise NotImplementedError
 
+def ingest(edges=(), objects=()):
+    """Queue rows to be written with the pending saves, without building
+    models for them.
+
+    edges are (kind, key1, key2, name, mode) tuples, where kind is the
+    table name of an association (such as 'blob_trees') and the keys
+    are as for that association's class.  name and mode are ignored for
+    associations without them.  objects are (id, type, repository_id)
+    tuples, recording that an object is in a repository.  Either may be
+    any iterable, so columns can be passed zipped together."""
+    global pending_saves
+    kinds = _get_edge_kinds()
+    for kind, key1, key2, name, mode in edges:
+        klass, named = kinds[kind]
+        row = {klass.key1_name : key1, klass.key2_name : key2}
+        if named:
+            row['name'] = sanitize_unicode(name)
+            row['mode'] = mode
+        _ingested.setdefault(klass, []).append(row)
+        pending_saves += 1
+        if max_pending_saves is not None and pending_saves >= max_pending_saves:
+            _save_batch()
+    for id, type, repository_id in objects:
+        _ingested.setdefault(GitObject, []).append({'id' : id, 'type' : type})
+        _ingested.setdefault(GitObjectRepository, []).append({'git_object_id' : id,
+                                                              'repository_id' : repository_id})
+        pending_saves += 2
+        if max_pending_saves is not None and pending_saves >= max_pending_saves:
+            _save_batch()
+
 ## Internal functions
 
 def _register_flush(fn):
-    global pending_saves, flush
-    def flush():
+    """Register fn(klass, documents) to write the documents for klass's
+    pending saves."""
+    global flush, _save_batch
+    def write(batches):
+        with stats.timer('db.flush'):
+            for klass, documents in batches:
+                stats.incr('db.flush.objects', len(documents))
+                fn(klass, documents)
+
+    def _save_batch():
         global pending_saves
-        for klass, instances in Model._needed_saves.iteritems():
-            fn(klass, instances)
+        # Pending saves are at their largest just before a flush
+        memory.sample(relieve_pressure=False)
+        batches = [(klass, [instance.get_updates() for instance in instances])
+                   for klass, instances in Model._needed_saves.iteritems()]
+        batches.extend(item for item in _ingested.iteritems() if item[1])
+        if not write_behind:
+            write(batches)
+        for instances in Model._needed_saves.itervalues():
             for instance in instances:
                 instance.mark_saved()
         Model._needed_saves.clear()
+        _ingested.clear()
         pending_saves = 0
+        if write_behind:
+            # The writer keeps hold of the batch even if this raises
+            writer.submit(write, batches)
+
+    def flush():
+        _save_batch()
+        writer.wait()
+
+def _save_batch():
+    """Write out the pending saves, or if write_behind is set, queue
+    them to be written."""
+    raise NotImplementedError
+
+
+class WriteBehind(object):
+    """Writes batches in a background thread, with at most
+    write_behind_batches of them waiting.  Submitting blocks while the
+    queue is full, so indexing is held back to the pace of the
+    database.
+
+    Once a write fails, it and every batch after it are held back, and
+    the error is raised by the next submit() or wait().  The held
+    batches are tried again, in order, by the submit() or wait() after
+    that, so nothing already marked saved is lost."""
+    def __init__(self):
+        self._queue = None
+        self._thread = None
+        self._exc_info = None
+        # Batches not written because of a failure, in order
+        self._unwritten = []
+
+    def submit(self, write, *args):
+        """Call write(*args) in the background."""
+        item = (stats.current_repo(), write, args)
+        if self._thread is None:
+            self._queue = Queue.Queue(write_behind_batches)
+            self._thread = threading.Thread(target=self._run, name='write-behind')
+            self._thread.daemon = True
+            self._thread.start()
+        self._retry()
+        if self._exc_info is not None:
+            # Let everything already queued be held back first
+            self._queue.join()
+            self._unwritten.append(item)
+            self._raise()
+        start = time.time()
+        self._queue.put(item)
+        stats.record_time('db.write_behind.wait', time.time() - start)
+
+    def wait(self):
+        """Wait for everything submitted to be written."""
+        if self._queue is None:
+            return
+        self._queue.join()
+        self._retry()
+        self._queue.join()
+        self._raise()
+
+    def pending(self):
+        """How many batches are waiting to be written."""
+        if self._queue is None:
+            return 0
+        return self._queue.qsize() + len(self._unwritten)
+
+    def _retry(self):
+        # Only once the failure has been raised, by which point
+        # nothing else is queued
+        if self._exc_info is not None or not self._unwritten:
+            return
+        unwritten, self._unwritten = self._unwritten, []
+        logger.info('Retrying %d batches that were held back' % len(unwritten))
+        for item in unwritten:
+            self._queue.put(item)
+
+    def _raise(self):
+        exc_info, self._exc_info = self._exc_info, None
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            repo, write, args = item
+            try:
+                if self._exc_info is None:
+                    with stats.repo(repo):
+                        write(*args)
+                else:
+                    self._unwritten.append(item)
+            except:
+                logger.exception('Write behind failed')
+                self._exc_info = sys.exc_info()
+                self._unwritten.append(item)
+            finally:
+                self._queue.task_done()
+
+writer = WriteBehind()
+memory.register('write_behind_batches', writer.pending)
+
+def _get_edge_kinds():
+    global _edge_kinds
+    if _edge_kinds is None:
+        _edge_kinds = {}
+        for klass in (BlobTree, BlobTag, TreeParentTree, TreeCommit, TreeTag,
+                      CommitParentCommit, CommitTree, CommitTag, TagParentTag):
+            named = any(field.name == 'name' for field in klass._fields)
+            _edge_kinds[klass.__tablename__] = (klass, named)
+    return _edge_kinds
 
 def classify(string):
     """Convert a class name to the corresponding class"""
@@ -93,20 +264,7 @@ def convert_iterable(target, dest):
         return dest(target)
 
 def make_persistent_attribute(name, default=None, extractor=None):
-    backend_attr = '__%s' % hex(random.getrandbits(128))
-    def _getter(self):
-        if not hasattr(self, backend_attr):
-            setattr(self, name, default)
-        return getattr(self, backend_attr)
-    def _setter(self, value):
-        if hasattr(self, backend_attr) and value == getattr(self, backend_attr):
-            return
-        self._changed = True
-        if extractor:
-            value = extractor(value)
-        self._pending_updates[name] = value
-        setattr(self, backend_attr, value)
-    return property(_getter, _setter)
+    return PersistentAttribute(name, default, extractor)
 
 def bool_extractor(b):
     if b == '0':
@@ -125,6 +283,61 @@ def datetime_extractor(d):
 ## Classes
 
 
+class PersistentAttribute(object):
+    """An attribute saved to the database as name.  ModelType gives it
+    a slot to keep its value in, and a bit.  The bit is set in the
+    instance's _loaded mask once it has a value, and in its _dirty
+    mask whenever it changes."""
+    def __init__(self, name, default=None, extractor=None):
+        self.name = name
+        self.default = default
+        self.extractor = extractor
+        # Set by ModelType
+        self.member = None
+        self.bit = 0
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if not instance._loaded & self.bit:
+            self.__set__(instance, self.default)
+        return self.member.__get__(instance, owner)
+
+    def __set__(self, instance, value):
+        # Checking the mask saves raising AttributeError from empty slots
+        if instance._loaded & self.bit and value == self.member.__get__(instance):
+            return
+        instance._changed = True
+        if self.extractor:
+            value = self.extractor(value)
+        self.member.__set__(instance, value)
+        instance._loaded |= self.bit
+        instance._dirty |= self.bit
+
+
+class ModelType(type):
+    """Metaclass for models.  Instances keep their attributes in slots
+    rather than a __dict__, and each PersistentAttribute gets a slot
+    and a dirty bit of its own.  Mixins of models need __slots__ = ()
+    for this to work."""
+    def __new__(meta, name, bases, namespace):
+        fields = sorted((key, value) for key, value in namespace.iteritems()
+                        if isinstance(value, PersistentAttribute))
+        namespace['__slots__'] = (tuple(namespace.get('__slots__', ())) +
+                                  tuple('_v_%s' % key for key, _ in fields))
+        cls = super(ModelType, meta).__new__(meta, name, bases, namespace)
+        inherited = []
+        for base in bases:
+            inherited.extend(field for field in getattr(base, '_fields', ())
+                             if field not in inherited)
+        for i, (key, field) in enumerate(fields):
+            field.member = cls.__dict__['_v_%s' % key]
+            field.bit = 1 << (len(inherited) + i)
+        # Every persistent attribute, in bit order
+        cls._fields = tuple(inherited) + tuple(field for _, field in fields)
+        return cls
+
+
 class Error(Exception):
     pass
 
@@ -160,9 +373,12 @@ class Map(object):
 
 class CommonMixin(object):
     """Functionality common to all backends."""
+    __slots__ = ()
+
     def __new__(cls, *args, **kwargs):
         instance = super(CommonMixin, cls).__new__(cls)
-        instance._errors = {}
+        # Most objects never have any, so the dict is made on demand
+        instance._errors = None
         return instance
 
     @classmethod
@@ -197,6 +413,8 @@ class CommonMixin(object):
             return True
 
     def error(self, attr, msg):
+        if self._errors is None:
+            self._errors = {}
         self._errors.setdefault(attr, []).append(msg)
 
     def validate(self):
@@ -205,6 +423,8 @@ class CommonMixin(object):
 
 github_re = re.compile('^git://github.com')
 class CommonRepositoryMixin(CommonMixin):
+    __slots__ = ()
+
     @classmethod
     def create(cls, url):
         id = sha1(url)
@@ -256,10 +476,12 @@ class CommonRepositoryMixin(CommonMixin):
 
 
 class CommonRemoteHeadMixin(CommonMixin):
-    pass
+    __slots__ = ()
 
 
 class CommonGitObjectMixin(CommonMixin):
+    __slots__ = ()
+
     def __str__(self):
         return "%s: %s" % (self.type, self.id)
     __repr__ = __str__
@@ -270,6 +492,8 @@ class CommonGitObjectMixin(CommonMixin):
             self.error("id", "Must provide an id")
 
 class CommonBlobMixin(CommonGitObjectMixin):
+    __slots__ = ()
+
     def get_path(self, repo, recursive=True):
         assert repo.id in self.repository_ids
         # Ok, recurse.
@@ -286,6 +510,8 @@ class CommonBlobMixin(CommonGitObjectMixin):
 
 
 class CommonTreeMixin(CommonGitObjectMixin):
+    __slots__ = ()
+
     def get_path(self, repo):
         assert repo.id in self.repository_ids
         # See if I have any commits from this repo.
@@ -304,27 +530,92 @@ class CommonTreeMixin(CommonGitObjectMixin):
 
 
 class CommonCommitMixin(CommonGitObjectMixin):
-    pass
+    __slots__ = ()
 
 
 class CommonTagMixin(CommonGitObjectMixin):
+    __slots__ = ()
+
     def validate(self):
         super(CommonTagMixin, self).validate()
         if not self.commit:
             self.error("commit", "Must provide a commit")
 
 
+class IdentityMap(object):
+    """Model instances by table and id, so that an object is built
+    once and then found again for as long as it's in use.  Objects
+    stay in the map after they're flushed, so that looking them up
+    again is cheap, but the least recently used are evicted past
+    max_size.  Objects waiting to be flushed are never evicted, since
+    building them again would save them twice.
+
+    The indexer writes through ingest(), so doesn't go through here."""
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def get(self, cls, id):
+        key = (cls.__tablename__, id)
+        try:
+            instance = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = instance
+        self.hits += 1
+        return instance
+
+    def add(self, instance):
+        key = (instance.__tablename__, instance.id)
+        self._entries.pop(key, None)
+        self._entries[key] = instance
+        max_size = self.max_size or identity_map_size
+        if len(self._entries) > max_size:
+            self.evict(len(self._entries) - max_size)
+
+    def evict(self, count):
+        """Evict up to count of the least recently used objects."""
+        # Objects waiting to be flushed go back on the end, so look at
+        # each object at most once
+        for _ in xrange(len(self._entries)):
+            if count <= 0:
+                break
+            key, instance = self._entries.popitem(last=False)
+            if instance._pending_save:
+                self._entries[key] = instance
+            else:
+                count -= 1
+
+    def clear(self):
+        """Evict everything that can be."""
+        self.evict(len(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+identity_map = IdentityMap()
+
+
 class Model(object):
+    __metaclass__ = ModelType
+    # _extra holds columns we don't have an attribute for
+    __slots__ = ('id', 'new', '_errors', '_changed', '_loaded', '_dirty', '_pending_save',
+                 '_extra')
     # Should provide these in subclasses
-    cache = {}
     mutable = False
     has_type = False
+    # Whether to keep saved instances in the identity map
+    cached = False
     _needed_saves = {}
 
     def __init__(self, _raw_dict={}, **kwargs):
-        self._pending_updates = {}
+        self._loaded = self._dirty = 0
+        self._extra = None
         self._init_from_dict(_raw_dict)
-        self._pending_updates.clear()
+        self._dirty = 0
         self._init_from_dict(kwargs)
         self.new = True
         self._pending_save = False
@@ -335,11 +626,32 @@ class Model(object):
             if k == 'type':
                 assert v == self.type
                 continue
-            setattr(self, k, v)
+            try:
+                setattr(self, k, v)
+            except AttributeError:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[k] = v
+
+    def __getattr__(self, name):
+        # Only called for attributes we don't have
+        if name != '_extra' and self._extra and name in self._extra:
+            return self._extra[name]
+        raise AttributeError('%r object has no attribute %r' % (type(self).__name__, name))
 
     def _set(self, attr, value):
-        # TODO: I think that setattr on sets is a bit borked.  Maybe fix that.
-        self._pending_updates[attr] = value
+        setattr(self, attr, value)
+        self._dirty |= getattr(type(self), attr).bit
+
+    def _dirty_fields(self):
+        """Return the persistent attributes that have changed, by name."""
+        dirty = self._dirty
+        fields = {}
+        if dirty:
+            for field in self._fields:
+                if dirty & field.bit:
+                    fields[field.name] = field.member.__get__(self)
+        return fields
 
     @property
     def type(self):
@@ -354,15 +666,25 @@ class Model(object):
     @classmethod
     def get(cls, id):
         """Get an item with the given primary key"""
-        return cls.get_by_attributes(id=id)
+        cached = cls.get_from_cache(id=id)
+        if cached:
+            return cached
+        else:
+            return cls.get_by_attributes(id=id)
 
     @classmethod
     def get_from_cache_or_new(cls, id):
-        return cls(id=id)
+        cached = cls.get_from_cache(id=id)
+        if cached:
+            return cached
+        else:
+            return cls(id=id)
 
     @classmethod
     def get_from_cache(cls, id):
-        return None
+        if not cls.cached:
+            return None
+        return identity_map.get(cls, id)
 
     @classmethod
     def get_by_attributes(cls, **kwargs):
@@ -404,7 +726,7 @@ class Model(object):
     def changed(self):
         """Indicate whether this object is changed from the version in
         the database.  Returns True for new objects."""
-        return self.new or self._changed or self._pending_updates
+        return self.new or self._changed or self._dirty
 
     def save(self):
         global pending_saves
@@ -430,8 +752,10 @@ class Model(object):
                             pending_saves += 1
                             self._pending_save = True
                             self._needed_saves.setdefault(type(self), []).append(self)
+                            if self.cached:
+                                identity_map.add(self)
                             if max_pending_saves is not None and pending_saves >= max_pending_saves:
-                                flush()
+                                _save_batch()
                 except:
                     logger.critical('Had some trouble saving %s' % self)
                     raise
@@ -458,18 +782,19 @@ class Model(object):
         return cls._object_store.find(kwargs)
 
     def get_updates(self):
+        updates = self._dirty_fields()
         # Hack to add *something* for new insertions
         if self.has_type:
-            self._pending_updates.setdefault('type', self.type)
+            updates.setdefault('type', self.type)
         if hasattr(self, 'id'):
-            self._pending_updates.setdefault('id', self.id)
-        return self._pending_updates
+            updates.setdefault('id', self.id)
+        return updates
 
     def mark_saved(self):
         self.new = False
         self._pending_save = False
         self._changed = False
-        self._pending_updates.clear()
+        self._dirty = 0
 
     def __str__(self):
         return '%s: %s' % (self.type, self.id)
@@ -519,7 +844,6 @@ class GitObjectAssociation(Model, CommonMixin):
 class BlobTree(GitObjectAssociation):
     __tablename__ = 'blob_trees'
     _save_list = []
-    _cache = {}
     key1_name = 'blob_id'
     key2_name = 'tree_id'
     blob_id = make_persistent_attribute('blob_id')
@@ -532,7 +856,6 @@ class BlobTree(GitObjectAssociation):
 class BlobTag(GitObjectAssociation):
     __tablename__ = 'blob_tags'
     _save_list = []
-    _cache = {}
     key1_name = 'blob_id'
     key2_name = 'tag_id'
     blob_id = make_persistent_attribute('blob_id')
@@ -543,7 +866,6 @@ class BlobTag(GitObjectAssociation):
 class TreeParentTree(GitObjectAssociation):
     __tablename__ = 'tree_parent_trees'
     _save_list = []
-    _cache = {}
     key1_name = 'tree_id'
     key2_name = 'parent_tree_id'
     tree_id = make_persistent_attribute('tree_id')
@@ -556,7 +878,6 @@ class TreeParentTree(GitObjectAssociation):
 class TreeCommit(GitObjectAssociation):
     __tablename__ = 'tree_commits'
     _save_list = []
-    _cache = {}
     key1_name = 'tree_id'
     key2_name = 'commit_id'
     tree_id = make_persistent_attribute('tree_id')
@@ -566,7 +887,6 @@ class TreeCommit(GitObjectAssociation):
 class TreeTag(GitObjectAssociation):
     __tablename__ = 'tree_tags'
     _save_list = []
-    _cache = {}
     key1_name = 'tree_id'
     key2_name = 'tag_id'
     tree_id = make_persistent_attribute('tree_id')
@@ -576,7 +896,6 @@ class TreeTag(GitObjectAssociation):
 class CommitParentCommit(GitObjectAssociation):
     __tablename__ = 'commit_parent_commits'
     _save_list = []
-    _cache = {}
     key1_name = 'commit_id'
     key2_name = 'parent_commit_id'
     commit_id = make_persistent_attribute('commit_id')
@@ -587,7 +906,6 @@ class CommitParentCommit(GitObjectAssociation):
 class CommitTree(GitObjectAssociation):
     __tablename__ = 'commit_trees'
     _save_list = []
-    _cache = {}
     key1_name = 'commit_id'
     key2_name = 'tree_id'
     commit_id = make_persistent_attribute('commit_id')
@@ -600,7 +918,6 @@ class CommitTree(GitObjectAssociation):
 class CommitTag(GitObjectAssociation):
     __tablename__ = 'commit_tags'
     _save_list = []
-    _cache = {}
     key1_name = 'commit_id'
     key2_name = 'tag_id'
     commit_id = make_persistent_attribute('commit_id')
@@ -610,16 +927,14 @@ class CommitTag(GitObjectAssociation):
 class TagParentTag(GitObjectAssociation):
     __tablename__ = 'tag_parent_tags'
     _save_list = []
-    _cache = {}
     key1_name = 'tag_id'
     key2_name = 'parent_tag_id'
-    commit_id = make_persistent_attribute('tag_id')
+    tag_id = make_persistent_attribute('tag_id')
     parent_tag_id = make_persistent_attribute('parent_tag_id')
 
 class GitObjectRepository(GitObjectAssociation):
     __tablename__ = 'git_object_repositories'
     _save_list = []
-    _cache = {}
     key1_name = 'git_object_id'
     key2_name = 'repository_id'
     git_object_id = make_persistent_attribute('git_object_id')
@@ -629,7 +944,6 @@ class GitObjectRepository(GitObjectAssociation):
 class CommitParentCommit(GitObjectAssociation):
     __tablename__ = 'commit_parent_commits'
     _save_list = []
-    _cache = {}
     key1_name = 'commit_id'
     key2_name = 'parent_commit_id'
     commit_id = make_persistent_attribute('commit_id')
@@ -639,8 +953,8 @@ class CommitParentCommit(GitObjectAssociation):
 class GitObject(Model, CommonGitObjectMixin):
     """The base class for git objects (such as blobs, commits, etc..)."""
     __tablename__ = 'git_objects'
+    cached = True
     _save_list = []
-    _cache = {}
 
     @classmethod
     def lookup_by_sha1(cls, sha1, partial=False, skip=None, limit=10):
@@ -686,6 +1000,28 @@ class GitObject(Model, CommonGitObjectMixin):
         gor = GitObjectRepository(self.id, repository_id)
         gor.save()
 
+    @classmethod
+    def find_complete(cls, ids):
+        """Return the subset of the given ids belonging to objects that
+        have been fully indexed in some repo."""
+        if not ids:
+            return set()
+        encode = cls._object_store._encode
+        query = ('select distinct gor.git_object_id from git_object_repositories as gor '
+                 'JOIN repositories as r on gor.repository_id = r.id '
+                 'where r.been_indexed = 1 and r.dirty = 0 and gor.git_object_id IN (%s)' %
+                 ','.join(encode(id) for id in ids))
+        return set(row['git_object_id'] for row in cls._object_store.select(query))
+
+    @classmethod
+    def iter_indexed_ids(cls):
+        """Yield the ids of objects in repos that have been fully indexed."""
+        query = ('select distinct gor.git_object_id from git_object_repositories as gor '
+                 'JOIN repositories as r on gor.repository_id = r.id '
+                 'where r.been_indexed = 1 and r.dirty = 0')
+        for row in cls._object_store.select(query):
+            yield row['git_object_id']
+
     @property
     def dirty(self):
         return bool_extractor(self._object_store.select('select count(*) as c from git_object_repositories as gor LEFT JOIN '
@@ -890,14 +1226,12 @@ class Repository(Model, CommonRepositoryMixin):
     _save_list = []
     __tablename__ = 'repositories'
 
-    # Attributes: url, last_index, indexing, commit_ids
+    # Attributes: url, last_index, lease_owner, lease_expires, next_index,
+    # last_changed, index_duration, commit_ids
     url = make_persistent_attribute('url')
     last_index = make_persistent_attribute('last_index',
                                            default=datetime.datetime(1970,1,1),
                                            extractor=datetime_extractor)
-    indexing = make_persistent_attribute('indexing',
-                                         default=False,
-                                         extractor=bool_extractor)
     been_indexed = make_persistent_attribute('been_indexed',
                                              default=False,
                                              extractor=bool_extractor)
@@ -910,15 +1244,21 @@ class Repository(Model, CommonRepositoryMixin):
     dirty = make_persistent_attribute('dirty',
                                       default=False,
                                       extractor=bool_extractor)
+    lease_owner = make_persistent_attribute('lease_owner')
+    lease_expires = make_persistent_attribute('lease_expires',
+                                              extractor=datetime_extractor)
+    # Scheduling; see anygit.client.priority
+    next_index = make_persistent_attribute('next_index',
+                                           extractor=datetime_extractor)
+    last_changed = make_persistent_attribute('last_changed',
+                                             extractor=datetime_extractor)
+    index_duration = make_persistent_attribute('index_duration',
+                                               default=0,
+                                               extractor=float)
 
     _remote_heads = make_persistent_attribute('_remote_heads', default='')
     _new_remote_heads = make_persistent_attribute('_new_remote_heads', default='')
 
-    def __init__(self, *args, **kwargs):
-        super(Repository, self).__init__(*args, **kwargs)
-        # Hack to default this, thus persisting it.
-        self.indexing
-
     @property
     def clean_remote_heads(self):
         if self.dirty:
@@ -935,20 +1275,79 @@ class Repository(Model, CommonRepositoryMixin):
         return (self._new_remote_heads or '').split(',')
 
     @classmethod
-    def get_indexed_before(cls, date, approved=None):
-        """Get all repos indexed before the given date and not currently
-        being indexed."""
+    def pop_next(cls, owner, ttl, approved=None, candidates=10):
+        """Claim the most overdue repo that is due for indexing and not
+        being indexed, taking a lease on it for owner.  Returns None if
+        no repos are due."""
         if approved is None:
             approved = 1
+        encode = cls._object_store._encode
+        while True:
+            now = datetime.datetime.now()
+            clauses = ['`approved` = %s' % encode(approved),
+                       '(`lease_expires` IS NULL OR `lease_expires` < %s)' % encode(now),
+                       '(`next_index` IS NULL OR `next_index` <= %s)' % encode(now)]
+            # NULLs (never scheduled) sort first
+            query = cls._object_store.find(' and '.join(clauses))
+            repos = list(query.order('next_index', 'ASC').limit(candidates))
+            if not repos:
+                return None
+            for repo in repos:
+                if repo.acquire_lease(owner, ttl):
+                    return repo
+            # Everything we looked at was claimed under us; look again
 
-        # Hack: should be lazier about this.
-        if date is not None:
-            return cls._object_store.find({'last_index' : {'$lt' : date},
-                                           'indexing' : 0,
-                                           'approved' : approved})
-        else:
-            return cls._object_store.find({'approved' : approved,
-                                           'indexing' : 0})
+    def _init_from_dict(self, dict):
+        # Superseded by leases, but may still be in old records
+        dict.pop('indexing', None)
+        super(Repository, self)._init_from_dict(dict)
+
+    @property
+    def indexing(self):
+        return self.lease_expires is not None and self.lease_expires > datetime.datetime.now()
+
+    def _set_clean(self, name, value):
+        """Set an attribute to a value we know is already in the database."""
+        setattr(self, name, value)
+        self._dirty &= ~getattr(type(self), name).bit
+
+    def acquire_lease(self, owner, ttl):
+        """Atomically claim this repo for ttl seconds, unless someone
+        else holds an unexpired lease on it.  The current holder may
+        call this again to renew.  Returns whether we hold the lease."""
+        encode = self._object_store._encode
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=ttl)
+        condition = ('(`lease_expires` IS NULL OR `lease_expires` < %s OR `lease_owner` = %s)' %
+                     (encode(now), encode(owner)))
+        updated = self._object_store.update_where(self.id,
+                                                  {'lease_owner' : owner,
+                                                   'lease_expires' : expires},
+                                                  condition)
+        if not updated:
+            # MySQL doesn't count rows it didn't change, which happens
+            # if we renew twice within a second.
+            row = self._object_store.select('select `lease_owner` from `%s` where `id` = %s' %
+                                            (self._object_store.name, encode(self.id))).next()
+            if row['lease_owner'] != owner:
+                return False
+        self._set_clean('lease_owner', owner)
+        self._set_clean('lease_expires', expires)
+        return True
+
+    def renew_lease(self, owner, ttl):
+        return self.acquire_lease(owner, ttl)
+
+    def release_lease(self, owner=None):
+        """Give up our lease.  If owner is None, break anyone's lease."""
+        condition = '1 = 1'
+        if owner is not None:
+            condition = '`lease_owner` = %s' % self._object_store._encode(owner)
+        self._object_store.execute_where(self.id,
+                                         'SET `lease_owner` = NULL, `lease_expires` = NULL',
+                                         condition)
+        self._set_clean('lease_owner', None)
+        self._set_clean('lease_expires', None)
 
     @classmethod
     def get_by_highest_count(cls, n=None, descending=True):
@@ -973,6 +1372,22 @@ class Repository(Model, CommonRepositoryMixin):
     def count_objects(self):
         return GitObjectRepository._object_store.find({'repository_id' : self.id}).count()
 
+    def mark_objects_complete(self):
+        """Nothing to do: an object is complete if any clean repo has it."""
+        pass
+
+    def get_commit_graph(self):
+        """Yield (commit id, parent id) for every parent link between
+        two commits in this repo, in a single query."""
+        encode = self._object_store._encode
+        query = ('select cpc.commit_id, cpc.parent_commit_id from commit_parent_commits as cpc '
+                 'JOIN git_object_repositories as c on c.git_object_id = cpc.commit_id '
+                 'JOIN git_object_repositories as p on p.git_object_id = cpc.parent_commit_id '
+                 'where c.repository_id = %s and p.repository_id = %s') % (encode(self.id),
+                                                                          encode(self.id))
+        for row in self._object_store.select(query):
+            yield row['commit_id'], row['parent_commit_id']
+
     # TODO: use this
     # def set_new_remote_heads(self, new_remote_heads):
     #     current_remote_heads = set(self.remote_heads)
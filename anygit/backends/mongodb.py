@@ -1,13 +1,13 @@
 import datetime
 import logging
 import pymongo
-import random
 import re
 import subprocess
 
-from pymongo import son_manipulator
+from pymongo import errors, son_manipulator
 from pylons import config
 
+from anygit import memory, stats
 from anygit.backends import common
 from anygit.data import exceptions
 
@@ -15,9 +15,25 @@ logger = logging.getLogger(__name__)
 
 max_transaction_window = 1000
 curr_transaction_window = 0
+# Most documents, and bytes of them, to send in one bulk write
+bulk_max_documents = 1000
+bulk_max_bytes = 8 * 1024 * 1024
+# Bytes to allow per document when estimating a batch's size, on top
+# of its name and any values it adds to sets.  Documents are written
+# as edges, memberships and small models, so this is generous;
+# pymongo splits any message that turns out too big itself.
+estimated_document_size = 256
+# Mongo's error code for a duplicate key
+DUPLICATE_KEY = 11000
 connection = None
 save_classes = []
 collection_to_class = {}
+# Documents from ingest() waiting to be written: associations by
+# class, and updates to git objects by id
+_ingested = {}
+_ingested_objects = {}
+# Association collection name -> (class, whether it has a name and mode)
+_edge_kinds = None
 
 ## Exported functions
 
@@ -30,6 +46,8 @@ def create_schema():
     Repository._object_store.ensure_index('url')
     Repository._object_store.ensure_index('approved')
     Repository._object_store.ensure_index('count')
+    Repository._object_store.ensure_index('lease_expires')
+    Repository._object_store.ensure_index('next_index')
 
 def init_model(connection):
     """Call me before using any of the tables or classes in the model."""
@@ -59,30 +77,193 @@ def setup():
     init_model(connection)
 
 def flush():
-    for klass in save_classes:
-        if klass._save_list:
-            logger.debug('Saving %d %s instances...' % (len(klass._save_list), klass.__name__))
+    _save_batch()
+    common.writer.wait()
+
+def ingest(edges=(), objects=()):
+    """Queue documents to be written with the pending saves, without
+    building models for them.  Takes the same tuples as
+    common.ingest.  Commit parents are added to the commit's
+    parent_ids, and memberships to the object's _repository_ids."""
+    kinds = _get_edge_kinds()
+    for kind, key1, key2, name, mode in edges:
+        if kind == 'commit_parent_commits':
+            _object_update(key1, 'commit', 'parent_ids', key2)
+        else:
+            klass, named = kinds[kind]
+            document = {'_id' : key1 + key2}
+            if named:
+                document['name'] = sanitize_unicode(name)
+                document['mode'] = mode
+            _ingested.setdefault(klass, []).append(document)
+        _count_ingested()
+    for id, type, repository_id in objects:
+        _object_update(id, type, '_repository_ids', repository_id)
+        _count_ingested()
+
+def _count_ingested():
+    global curr_transaction_window
+    curr_transaction_window += 1
+    if curr_transaction_window >= max_transaction_window:
+        _save_batch()
+        curr_transaction_window = 0
+
+def _object_update(id, type, set_name, value):
+    try:
+        updates = _ingested_objects[id]
+    except KeyError:
+        updates = _ingested_objects[id] = {'$set' : {'type' : type}, '$addToSet' : {}}
+    target_set = updates['$addToSet'].setdefault(set_name, {'$each' : []})
+    target_set['$each'].append(value)
+
+def _get_edge_kinds():
+    global _edge_kinds
+    if _edge_kinds is None:
+        _edge_kinds = {}
+        for klass in (BlobTree, BlobTag, TreeParentTree, TreeCommit, TreeTag,
+                      CommitParentCommit, CommitTree, CommitTag, TagParentTag):
+            named = any(field.name == 'name' for field in klass._fields)
+            _edge_kinds[klass.__tablename__] = (klass, named)
+    return _edge_kinds
+
+def _save_batch():
+    """Write out the pending saves, or if common.write_behind is set,
+    queue them to be written."""
+    # Pending saves are at their largest just before a flush
+    memory.sample(relieve_pressure=False)
+    batches = _take_batches()
+    if common.write_behind:
+        common.writer.submit(_write, batches)
+    else:
+        _write(batches)
 
+def _write(batches):
+    with stats.timer('db.flush'):
+        for klass, documents in batches:
+            _flush(klass, documents)
+
+def _take_batches():
+    """Collect the documents to write for each class's pending saves,
+    and mark them saved."""
+    batches = []
+    for klass in save_classes:
+        if not klass._save_list:
+            continue
+        # Mutable documents are upserted as (spec, update) pairs, and
+        # immutable ones inserted whole
+        documents = []
         for instance in klass._save_list:
             try:
                 updates = instance.get_updates()
-                if klass.mutable:
-                    klass._object_store.update({'_id' : instance.id},
-                                               updates,
-                                               upsert=True)
-                else:
-                    updates.setdefault('_id', instance.id)
-                    klass._object_store.insert(updates)
             except:
                 logger.critical('Had some trouble saving %s' % instance)
                 raise
+            if klass.mutable:
+                documents.append(({'_id' : instance.id}, updates))
+            else:
+                updates.setdefault('_id', instance.id)
+                documents.append(updates)
+        batches.append((klass, documents))
+        for instance in klass._save_list:
             instance.mark_saved()
             instance.new = False
             instance._pending_save = False
             instance._changed = False
-            instance._pending_updates.clear()
         klass._save_list = klass._save_list[0:0]
-        klass._cache.clear()
+    for klass, documents in _ingested.iteritems():
+        if documents:
+            batches.append((klass, documents))
+    if _ingested_objects:
+        batches.append((GitObject, [({'_id' : id}, updates)
+                                    for id, updates in _ingested_objects.iteritems()]))
+    _ingested.clear()
+    _ingested_objects.clear()
+    return batches
+
+def _flush(klass, documents):
+    logger.debug('Saving %d %s instances...' % (len(documents), klass.__name__))
+    stats.incr('db.flush.objects', len(documents))
+    try:
+        for batch in _batches(documents):
+            stats.incr('db.operations')
+            if klass.mutable:
+                _bulk_upsert(klass._object_store, batch)
+            else:
+                _bulk_insert(klass._object_store, batch)
+    except:
+        logger.critical('Had some trouble saving %d %s instances' %
+                        (len(documents), klass.__name__))
+        raise
+
+def _batches(documents):
+    """Split documents into batches of at most bulk_max_documents and
+    (by estimate, unless a single document is bigger) bulk_max_bytes."""
+    batch = []
+    size = 0
+    for document in documents:
+        document_size = _estimated_size(document)
+        if batch and (len(batch) >= bulk_max_documents or
+                      size + document_size > bulk_max_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(document)
+        size += document_size
+    if batch:
+        yield batch
+
+def _estimated_size(document):
+    # Encoding each document just to measure it would double the cost
+    # of encoding, so go by the parts that can be large
+    size = estimated_document_size
+    if isinstance(document, tuple):
+        for target in document[1].get('$addToSet', {}).itervalues():
+            size += 48 * len(target['$each'])
+    else:
+        name = document.get('name')
+        if name:
+            size += len(name)
+    return size
+
+def _bulk_insert(collection, documents):
+    """Insert documents all at once.  They're immutable, so one that's
+    already there has already been written by someone else, and is
+    skipped without stopping the rest."""
+    try:
+        collection.insert(documents, continue_on_error=True)
+    except errors.DuplicateKeyError, e:
+        logger.debug('Skipped documents already in %s: %s' % (collection.name, e))
+
+def _bulk_upsert(collection, pairs):
+    """Apply each (spec, update) in pairs as an upsert, all at once."""
+    if not hasattr(collection, 'initialize_unordered_bulk_op'):
+        # No bulk API before pymongo 2.7
+        for spec, updates in pairs:
+            collection.update(spec, updates, upsert=True)
+        return
+    bulk = collection.initialize_unordered_bulk_op()
+    for spec, updates in pairs:
+        bulk.find(spec).upsert().update_one(updates)
+    try:
+        bulk.execute()
+    except errors.BulkWriteError, e:
+        details = e.details
+        if (details.get('writeConcernErrors') or
+            any(error['code'] != DUPLICATE_KEY for error in details['writeErrors'])):
+            raise
+        # Someone else created the document between our upsert
+        # looking for it and inserting it.  It's there now, so this
+        # time the update will apply.
+        for error in details['writeErrors']:
+            spec, updates = pairs[error['index']]
+            collection.update(spec, updates, upsert=True)
+
+def _pending_saves():
+    return (sum(len(klass._save_list) for klass in save_classes) +
+            sum(len(documents) for documents in _ingested.itervalues()) +
+            len(_ingested_objects))
+
+memory.register('pending_saves', _pending_saves, flush)
 
 def destroy_session():
     if connection is not None:
@@ -145,33 +326,10 @@ def convert_iterable(target, dest):
 
 def make_persistent_set():
     # TODO: transparently diff and persist this.
-    backend_attr = '__%s' % hex(random.getrandbits(128))
-    def _getter(self):
-        if not hasattr(self, backend_attr):
-            setattr(self, backend_attr, set())
-        return getattr(self, backend_attr)
-    def _setter(self, value):
-        value = set(convert_iterable(entry, tuple) for entry in value)
-        setattr(self, backend_attr, value)
-    return property(_getter, _setter)
+    return PersistentSet()
 
 def make_persistent_attribute(name, default=None):
-    backend_attr = '__%s' % hex(random.getrandbits(128))
-    def _getter(self):
-        if not hasattr(self, backend_attr):
-            setattr(self, name, default)
-        return getattr(self, backend_attr)
-    def _setter(self, value):
-        if hasattr(self, backend_attr) and value == getattr(self, backend_attr):
-            return
-        self._changed = True
-        if self.mutable:
-            setting = self._pending_updates.setdefault('$set', {})
-            setting[name] = value
-        else:
-            self._pending_updates[name] = value
-        setattr(self, backend_attr, value)
-    return property(_getter, _setter)
+    return common.PersistentAttribute(name, default)
 
 def rename_dict_keys(dict, to_backend=True):
     attrs = [('_id', 'id')]
@@ -189,6 +347,24 @@ def rename_dict_keys(dict, to_backend=True):
 ## Classes
 
 
+class PersistentSet(common.PersistentAttribute):
+    """A set attribute.  Additions are saved with _add_all_to_set, so
+    it never marks itself dirty."""
+    def __init__(self):
+        super(PersistentSet, self).__init__(None)
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        if not instance._loaded & self.bit:
+            self.__set__(instance, ())
+        return self.member.__get__(instance, owner)
+
+    def __set__(self, instance, value):
+        self.member.__set__(instance, set(convert_iterable(entry, tuple) for entry in value))
+        instance._loaded |= self.bit
+
+
 class Error(Exception):
     pass
 
@@ -239,20 +415,30 @@ class Map(object):
 
 
 class MongoDbModel(object):
+    __metaclass__ = common.ModelType
+    # _pending_ops holds updates other than to persistent attributes,
+    # such as $addToSet.  _extra holds keys we don't have an attribute
+    # for.
+    __slots__ = ('id', 'new', '_errors', '_changed', '_loaded', '_dirty', '_pending_save',
+                 '_pending_ops', '_extra')
     # Should provide these in subclasses
     mutable = True
-    _cache = {}
     _save_list = None
     batched = True
     has_type = False
+    # Whether to keep saved instances in the identity map
+    cached = False
 
     # Attributes: id, type
 
     def __init__(self, _raw_dict={}, **kwargs):
         rename_dict_keys(kwargs, to_backend=True)
-        self._pending_updates = {}
+        self._loaded = self._dirty = 0
+        self._pending_ops = None
+        self._extra = None
         self._init_from_dict(_raw_dict)
-        self._pending_updates.clear()
+        self._dirty = 0
+        self._pending_ops = None
 
         self._init_from_dict(kwargs)
         self.new = True
@@ -265,15 +451,41 @@ class MongoDbModel(object):
             if k == 'type':
                 assert v == self.type
                 continue
-            setattr(self, k, v)
+            try:
+                setattr(self, k, v)
+            except AttributeError:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[k] = v
+
+    def __getattr__(self, name):
+        # Only called for attributes we don't have
+        if name != '_extra' and self._extra and name in self._extra:
+            return self._extra[name]
+        raise AttributeError('%r object has no attribute %r' % (type(self).__name__, name))
+
+    def _ops(self):
+        if self._pending_ops is None:
+            self._pending_ops = {}
+        return self._pending_ops
 
     def _set(self, attr, value):
         # TODO: I think that setattr on sets is a bit borked.  Maybe fix that.
         if self.mutable:
-            setter = self._pending_updates.setdefault('$set', {})
+            setter = self._ops().setdefault('$set', {})
             setter[attr] = value
         else:
-            self._pending_updates[attr] = value
+            self._ops()[attr] = value
+
+    def _dirty_fields(self):
+        """Return the persistent attributes that have changed, by name."""
+        dirty = self._dirty
+        fields = {}
+        if dirty:
+            for field in self._fields:
+                if dirty & field.bit:
+                    fields[field.name] = field.member.__get__(self)
+        return fields
 
     def _add_all_to_set(self, set_name, values):
         # TODO: to get the *right* semantics, should have a committed updates
@@ -285,7 +497,7 @@ class MongoDbModel(object):
         if not values:
             return
         full_set.update(values)
-        adding = self._pending_updates.setdefault('$addToSet', {})
+        adding = self._ops().setdefault('$addToSet', {})
         target_set = adding.setdefault(set_name, {'$each' : []})
         target_set['$each'].extend(values)
         
@@ -321,10 +533,9 @@ class MongoDbModel(object):
 
     @classmethod
     def get_from_cache(cls, id):
-        if cls._cache and id in cls._cache:
-            return cls._cache[id]
-        else:
+        if not cls.cached:
             return None
+        return common.identity_map.get(cls, id)
 
     @classmethod
     def get_by_attributes(cls, **kwargs):
@@ -366,7 +577,7 @@ class MongoDbModel(object):
     def changed(self):
         """Indicate whether this object is changed from the version in
         the database.  Returns True for new objects."""
-        return self.new or self._changed or self._pending_updates
+        return self.new or self._changed or self._dirty or self._pending_ops
 
     def save(self):
         global curr_transaction_window
@@ -377,11 +588,12 @@ class MongoDbModel(object):
             elif self.batched:
                 if self._pending_save:
                     return
-                self._cache[self.id] = self
                 self._save_list.append(self)
                 self._pending_save = True
+                if self.cached:
+                    common.identity_map.add(self)
                 if curr_transaction_window >= max_transaction_window:
-                    flush()
+                    _save_batch()
                     curr_transaction_window = 0
                 else:
                     curr_transaction_window += 1
@@ -412,22 +624,28 @@ class MongoDbModel(object):
         return cls._object_store.find(kwargs)
 
     def get_updates(self):
+        updates = self._ops()
+        fields = self._dirty_fields()
         # Hack to add *something* for new insertions
         if self.mutable:
+            setting = updates.setdefault('$set', {})
+            setting.update(fields)
             if self.has_type:
-                self._pending_updates.setdefault('$set', {}).setdefault('type', self.type)
+                setting.setdefault('type', self.type)
             else:
-                self._pending_updates.setdefault('$set', {}).setdefault('__d', 0)
+                setting.setdefault('__d', 0)
         else:
+            updates.update(fields)
             if self.has_type:
-                self._pending_updates.setdefault('type', self.type)
-        return self._pending_updates
+                updates.setdefault('type', self.type)
+        return updates
 
     def mark_saved(self):
         self.new = False
         self._pending_save = False
         self._changed = False
-        self._pending_updates.clear()
+        self._dirty = 0
+        self._pending_ops = None
 
     def __str__(self):
         return '%s: %s' % (self.type, self.id)
@@ -443,6 +661,7 @@ class MongoDbModel(object):
 
 
 class GitObjectAssociation(MongoDbModel, common.CommonMixin):
+    __slots__ = ('_id',)
     mutable = False
     has_type = False
     key1_name = None
@@ -481,9 +700,9 @@ class GitObjectAssociation(MongoDbModel, common.CommonMixin):
 class BlobTree(GitObjectAssociation):
     __tablename__ = 'blob_trees'
     _save_list = []
-    _cache = {}
     key1_name = 'blob_id'
     key2_name = 'tree_id'
+    __slots__ = ('blob_id', 'tree_id')
 
     name = make_persistent_attribute('name')
     mode = make_persistent_attribute('mode')
@@ -492,17 +711,17 @@ class BlobTree(GitObjectAssociation):
 class BlobTag(GitObjectAssociation):
     __tablename__ = 'blob_tags'
     _save_list = []
-    _cache = {}
     key1_name = 'blob_id'
     key2_name = 'tag_id'
+    __slots__ = ('blob_id', 'tag_id')
 
 
 class TreeParentTree(GitObjectAssociation):
     __tablename__ = 'tree_parent_trees'
     _save_list = []
-    _cache = {}
     key1_name = 'tree_id'
     key2_name = 'parent_tree_id'
+    __slots__ = ('tree_id', 'parent_tree_id')
 
     name = make_persistent_attribute('name')
     mode = make_persistent_attribute('mode')
@@ -511,33 +730,33 @@ class TreeParentTree(GitObjectAssociation):
 class TreeCommit(GitObjectAssociation):
     __tablename__ = 'tree_commits'
     _save_list = []
-    _cache = {}
     key1_name = 'tree_id'
     key2_name = 'commit_id'
+    __slots__ = ('tree_id', 'commit_id')
 
 
 class TreeTag(GitObjectAssociation):
     __tablename__ = 'tree_tags'
     _save_list = []
-    _cache = {}
     key1_name = 'tree_id'
     key2_name = 'tag_id'
+    __slots__ = ('tree_id', 'tag_id')
 
 
 class CommitParentCommit(GitObjectAssociation):
     __tablename__ = 'commit_parent_commits'
     _save_list = []
-    _cache = {}
     key1_name = 'commit_id'
     key2_name = 'parent_commit_id'
+    __slots__ = ('commit_id', 'parent_commit_id')
 
 
 class CommitTree(GitObjectAssociation):
     __tablename__ = 'commit_trees'
     _save_list = []
-    _cache = {}
     key1_name = 'commit_id'
     key2_name = 'tree_id'
+    __slots__ = ('commit_id', 'tree_id')
 
     name = make_persistent_attribute('name')
     mode = make_persistent_attribute('mode')
@@ -546,17 +765,17 @@ class CommitTree(GitObjectAssociation):
 class CommitTag(GitObjectAssociation):
     __tablename__ = 'commit_tags'
     _save_list = []
-    _cache = {}
     key1_name = 'commit_id'
     key2_name = 'tag_id'
+    __slots__ = ('commit_id', 'tag_id')
 
 
 class TagParentTag(GitObjectAssociation):
     __tablename__ = 'tag_parent_tags'
     _save_list = []
-    _cache = {}
     key1_name = 'tag_id'
     key2_name = 'parent_tag_id'
+    __slots__ = ('tag_id', 'parent_tag_id')
 
 
 class GitObject(MongoDbModel, common.CommonGitObjectMixin):
@@ -564,8 +783,8 @@ class GitObject(MongoDbModel, common.CommonGitObjectMixin):
     # Attributes: repository_ids, tag_ids, dirty
     __tablename__ = 'git_objects'
     has_type = True
+    cached = True
     _save_list = []
-    _cache = {}
     _repository_ids = make_persistent_set()
     dirty = make_persistent_attribute('dirty')
     # Has been completely indexed in at least one repo
@@ -617,6 +836,27 @@ class GitObject(MongoDbModel, common.CommonGitObjectMixin):
         repository_id = canonicalize_to_id(repository_id)
         self._add_to_set('_repository_ids', repository_id)
 
+    @classmethod
+    def find_complete(cls, ids):
+        """Return the subset of the given ids belonging to objects that
+        have been fully indexed in some repo."""
+        if not ids:
+            return set()
+        return set(son['_id'] for son in
+                   cls._raw_object_store.find({'_id' : {'$in' : list(ids)}, 'complete' : True},
+                                              fields=[]))
+
+    @classmethod
+    def iter_indexed_ids(cls):
+        """Yield the ids of objects in repos that have been fully indexed."""
+        repository_ids = [son['_id'] for son in
+                          Repository._raw_object_store.find({'been_indexed' : True,
+                                                             'dirty' : {'$ne' : True}},
+                                                            fields=[])]
+        for son in cls._raw_object_store.find({'_repository_ids' : {'$in' : repository_ids}},
+                                              fields=[]):
+            yield son['_id']
+
 
 class Blob(GitObject, common.CommonBlobMixin):
     """Represents a git Blob.  Has an id (the sha1 that identifies this
@@ -794,33 +1034,93 @@ class Repository(MongoDbModel, common.CommonRepositoryMixin):
     _save_list = []
     __tablename__ = 'repositories'
 
-    # Attributes: url, last_index, indexing, commit_ids
+    # Attributes: url, last_index, lease_owner, lease_expires, next_index,
+    # last_changed, index_duration, commit_ids
     url = make_persistent_attribute('url')
     last_index = make_persistent_attribute('last_index', default=datetime.datetime(1970,1,1))
-    indexing = make_persistent_attribute('indexing', default=False)
     remote_heads = make_persistent_attribute('remote_heads')
     new_remote_heads = make_persistent_attribute('new_remote_heads')
     been_indexed = make_persistent_attribute('been_indexed', default=False)
     approved = make_persistent_attribute('approved', default=False)
     count = make_persistent_attribute('count', default=0)
-
-    def __init__(self, *args, **kwargs):
-        super(Repository, self).__init__(*args, **kwargs)
-        # Hack to default this, thus persisting it.
-        self.indexing
+    lease_owner = make_persistent_attribute('lease_owner')
+    lease_expires = make_persistent_attribute('lease_expires')
+    # Scheduling; see anygit.client.priority
+    next_index = make_persistent_attribute('next_index')
+    last_changed = make_persistent_attribute('last_changed')
+    index_duration = make_persistent_attribute('index_duration', default=0)
 
     @classmethod
-    def get_indexed_before(cls, date):
-        """Get all repos indexed before the given date and not currently
-        being indexed."""
-        # Hack: should be lazier about this.
-        if date is not None:
-            return cls._object_store.find({'last_index' : {'$lt' : date},
-                                           'indexing' : False,
-                                           'approved' : True})
-        else:
-            return cls._object_store.find({'approved' : True,
-                                           'indexing' : False})
+    def pop_next(cls, owner, ttl, approved=None):
+        """Claim the most overdue repo that is due for indexing and not
+        being indexed, taking a lease on it for owner.  Returns None if
+        no repos are due."""
+        if approved is None:
+            approved = True
+        # Callers may pass the command line's '1'; we store a boolean
+        approved = bool(int(approved))
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=ttl)
+        # Can't have two $ors in one query, so spell out their product
+        son = cls._raw_object_store.find_and_modify(
+            query={'approved' : approved,
+                   '$or' : [{'lease_expires' : None, 'next_index' : None},
+                            {'lease_expires' : None, 'next_index' : {'$lte' : now}},
+                            {'lease_expires' : {'$lt' : now}, 'next_index' : None},
+                            {'lease_expires' : {'$lt' : now}, 'next_index' : {'$lte' : now}}]},
+            update={'$set' : {'lease_owner' : owner,
+                              'lease_expires' : expires}},
+            sort=[('next_index', pymongo.ASCENDING)],
+            new=True)
+        if not son:
+            return None
+        return cls.demongofy(son)
+
+    def _init_from_dict(self, dict):
+        # Superseded by leases, but may still be in old records
+        dict.pop('indexing', None)
+        super(Repository, self)._init_from_dict(dict)
+
+    @property
+    def indexing(self):
+        return self.lease_expires is not None and self.lease_expires > datetime.datetime.now()
+
+    def _set_clean(self, name, value):
+        """Set an attribute to a value we know is already in the database."""
+        setattr(self, name, value)
+        self._dirty &= ~getattr(type(self), name).bit
+
+    def acquire_lease(self, owner, ttl):
+        """Atomically claim this repo for ttl seconds, unless someone
+        else holds an unexpired lease on it.  The current holder may
+        call this again to renew.  Returns whether we hold the lease."""
+        now = datetime.datetime.now()
+        expires = now + datetime.timedelta(seconds=ttl)
+        result = self._object_store.update({'_id' : self.id,
+                                            '$or' : [{'lease_expires' : None},
+                                                     {'lease_expires' : {'$lt' : now}},
+                                                     {'lease_owner' : owner}]},
+                                           {'$set' : {'lease_owner' : owner,
+                                                      'lease_expires' : expires}},
+                                           safe=True)
+        if not result.get('n'):
+            return False
+        self._set_clean('lease_owner', owner)
+        self._set_clean('lease_expires', expires)
+        return True
+
+    def renew_lease(self, owner, ttl):
+        return self.acquire_lease(owner, ttl)
+
+    def release_lease(self, owner=None):
+        """Give up our lease.  If owner is None, break anyone's lease."""
+        query = {'_id' : self.id}
+        if owner is not None:
+            query['lease_owner'] = owner
+        self._object_store.update(query, {'$set' : {'lease_owner' : None,
+                                                    'lease_expires' : None}})
+        self._set_clean('lease_owner', None)
+        self._set_clean('lease_expires', None)
 
     @classmethod
     def get_by_highest_count(cls, n=None, descending=True):
@@ -841,6 +1141,28 @@ class Repository(MongoDbModel, common.CommonRepositoryMixin):
     def count_objects(self):
         return GitObject._object_store.find({'_repository_ids' : self.id}).count()
 
+    def mark_objects_complete(self):
+        """Mark every object in this repo as completely indexed, as
+        GitObject.mark_dirty(False) does for a single object."""
+        GitObject._raw_object_store.update({'_repository_ids' : self.id,
+                                            'complete' : {'$ne' : True}},
+                                           {'$set' : {'complete' : True}},
+                                           multi=True)
+
+    def get_commit_graph(self):
+        """Yield (commit id, parent id) for every parent link between
+        two clean commits in this repo, in a single query."""
+        commits = {}
+        for son in GitObject._raw_object_store.find({'type' : 'commit',
+                                                     '_repository_ids' : self.id,
+                                                     'dirty' : {'$ne' : True}},
+                                                    fields=['parent_ids']):
+            commits[son['_id']] = son.get('parent_ids', ())
+        for commit_id, parent_ids in commits.iteritems():
+            for parent_id in parent_ids:
+                if parent_id in commits:
+                    yield commit_id, parent_id
+
     def set_new_remote_heads(self, new_remote_heads):
         self.new_remote_heads = list(new_remote_heads)
 
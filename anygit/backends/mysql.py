@@ -4,9 +4,11 @@ import MySQLdb
 import random
 import re
 import subprocess
+import threading
 
 from pylons import config
 
+from anygit import memory, stats
 from anygit.backends import common
 from anygit.data import exceptions
 
@@ -14,6 +16,8 @@ logger = logging.getLogger(__name__)
 
 connection = None
 collection_to_class = {}
+# The connection is shared with the write behind thread
+_lock = threading.Lock()
 
 sha1_re = re.compile('^[a-f0-9]*')
 
@@ -22,9 +26,14 @@ sha1_re = re.compile('^[a-f0-9]*')
 def create_schema():
     print 'Huhh??'
 
-def _flush(klass, instances):
-    klass._object_store.insert_all(instance.get_updates() for instance in instances)
+# Rows are queued alongside the models' pending saves, and written by
+# _flush as they are
+ingest = common.ingest
+
+def _flush(klass, documents):
+    klass._object_store.insert_all(documents)
 common._register_flush(_flush)
+memory.register('pending_saves', lambda: common.pending_saves, lambda: common.flush())
 
 def init_model(connection):
     """Call me before using any of the tables or classes in the model."""
@@ -175,7 +184,9 @@ class Domain(object):
         return Query(self, '%s LIKE "%s%%"' % (attr, value))
 
     def _encode(self, value):
-        if isinstance(value, bool):
+        if value is None:
+            return 'NULL'
+        elif isinstance(value, bool):
             if value:
                 return '1'
             else:
@@ -237,6 +248,18 @@ class Domain(object):
         query = 'UPDATE `%s` SET %s WHERE `id` = %s' % (self.name, args, self._encode(id))
         self._execute(query)
 
+    def update_where(self, id, attributes, condition):
+        """Update the row with the given id only if condition holds.
+        Returns the number of rows changed."""
+        keys, values = self._prepare_params(None, attributes)
+        args = ', '.join('%s=%s' % (k, v) for k, v in zip(keys, values))
+        return self.execute_where(id, 'SET %s' % args, condition)
+
+    def execute_where(self, id, set_clause, condition):
+        query = 'UPDATE `%s` %s WHERE `id` = %s AND %s' % (self.name, set_clause,
+                                                           self._encode(id), condition)
+        return self._execute(query)
+
     def select(self, query_string):
         cursor = self.connection.cursor(MySQLdb.cursors.DictCursor)
         self._execute(query_string, cursor=cursor)
@@ -246,6 +269,8 @@ class Domain(object):
         self._execute('DROP TABLE `%s`' % self.name)
 
     def _execute(self, query_string, cursor=None):
-        if not cursor:
-            cursor = self.connection.cursor()
-        return cursor.execute(query_string)
+        stats.incr('db.operations')
+        with _lock:
+            if not cursor:
+                cursor = self.connection.cursor()
+            return cursor.execute(query_string)
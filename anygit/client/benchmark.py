@@ -0,0 +1,303 @@
+"""Microbenchmarks for the pack parsing paths.
+
+Synthetic repos are generated offline with git fast-import, each
+shaped to stress something different, and packed.  Each parsing path
+is then timed over each pack in a fresh process, so that its peak RSS
+is its own.  Results can be saved as a baseline and later runs
+compared against it."""
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+from dulwich import pack
+from anygit.client import git_parser, packs
+
+try:
+    import multiprocessing
+except ImportError:
+    import processing as multiprocessing
+
+logger = logging.getLogger(__name__)
+
+# A run is a regression if it's this much slower than the baseline
+tolerance = 0.2
+
+
+## Synthetic repos.  Each writes a fast-import stream of roughly
+## scale units of work.
+
+def _blob(out, mark, data):
+    out.write('blob\nmark :%d\ndata %d\n%s\n' % (mark, len(data), data))
+
+def _commit(out, mark, message, parent, files, timestamp):
+    out.write('commit refs/heads/master\nmark :%d\n' % mark)
+    out.write('committer Bench <bench@example.com> %d +0000\n' % timestamp)
+    out.write('data %d\n%s\n' % (len(message), message))
+    if parent:
+        out.write('from :%d\n' % parent)
+    for path, blob_mark in files:
+        out.write('M 100644 :%d %s\n' % (blob_mark, path))
+
+def wide_trees(out, scale):
+    """A few commits over directories with thousands of entries."""
+    mark = 0
+    parent = None
+    for commit in xrange(5):
+        files = []
+        for i in xrange(2000 * scale):
+            mark += 1
+            _blob(out, mark, 'file %d version %d\n' % (i, commit))
+            files.append(('dir%d/file%06d.txt' % (i % 4, i), mark))
+        mark += 1
+        _commit(out, mark, 'Commit %d' % commit, parent, files, 1000000000 + commit)
+        parent = mark
+
+def deep_history(out, scale):
+    """A long line of small commits."""
+    mark = 0
+    parent = None
+    for commit in xrange(2000 * scale):
+        mark += 1
+        _blob(out, mark, 'line %d\n' % commit)
+        mark += 1
+        _commit(out, mark, 'Commit %d' % commit, parent,
+                [('src/file%d.txt' % (commit % 50), mark - 1)], 1000000000 + commit)
+        parent = mark
+
+def many_tags(out, scale):
+    """Lots of annotated tags."""
+    mark = 0
+    parent = None
+    for commit in xrange(500 * scale):
+        mark += 1
+        _blob(out, mark, 'release %d\n' % commit)
+        mark += 1
+        _commit(out, mark, 'Release %d' % commit, parent,
+                [('VERSION', mark - 1)], 1000000000 + commit)
+        parent = mark
+        message = 'Version %d' % commit
+        out.write('tag v%d\nfrom :%d\ntagger Bench <bench@example.com> %d +0000\n'
+                  'data %d\n%s\n' % (commit, mark, 1000000000 + commit, len(message), message))
+
+def delta_heavy(out, scale):
+    """A few large files edited a little at a time, so nearly
+    everything packs as a delta."""
+    lines = ['line %d of a reasonably long file\n' % i for i in xrange(5000)]
+    mark = 0
+    parent = None
+    for commit in xrange(300 * scale):
+        lines[(commit * 37) % len(lines)] = 'edited in commit %d\n' % commit
+        files = []
+        for f in xrange(3):
+            mark += 1
+            _blob(out, mark, ''.join(lines[f:] + lines[:f]))
+            files.append(('big%d.txt' % f, mark))
+        mark += 1
+        _commit(out, mark, 'Edit %d' % commit, parent, files, 1000000000 + commit)
+        parent = mark
+
+scenarios = {'wide_trees' : wide_trees,
+             'deep_history' : deep_history,
+             'many_tags' : many_tags,
+             'delta_heavy' : delta_heavy}
+
+def make_repo(workdir, scenario, scale=1):
+    """Build the named synthetic repo as a bare repo under workdir,
+    fully packed, and return its path."""
+    repo = os.path.join(workdir, scenario)
+    if os.path.exists(repo):
+        shutil.rmtree(repo)
+    subprocess.check_call([git_parser.GIT_CMD, 'init', '--quiet', '--bare', repo])
+    importer = subprocess.Popen([git_parser.GIT_CMD, 'fast-import', '--quiet'],
+                                cwd=repo, stdin=subprocess.PIPE)
+    scenarios[scenario](importer.stdin, scale)
+    importer.stdin.close()
+    if importer.wait():
+        raise subprocess.CalledProcessError(importer.returncode, 'git fast-import')
+    subprocess.check_call([git_parser.GIT_CMD, 'repack', '-a', '-d', '-f', '-q',
+                           '--depth=50', '--window=50'], cwd=repo)
+    return repo
+
+def make_pack(workdir, scenario, scale=1):
+    """Build the named synthetic repo under workdir and return the
+    path of its pack."""
+    repo = make_repo(workdir, scenario, scale)
+    pack_dir = os.path.join(repo, 'objects', 'pack')
+    name, = [name for name in os.listdir(pack_dir) if name.endswith('.pack')]
+    return os.path.join(pack_dir, name)
+
+
+## Parsing paths.  Each takes a pack path and returns the number of
+## objects read.
+
+def read_dulwich(path):
+    count = 0
+    for obj in pack.Pack(path[:-len('.pack')]).iterobjects():
+        git_parser.wrap_dulwich_object(obj)
+        count += 1
+    return count
+
+def read_reader(path):
+    reader = packs.PackReader(path)
+    try:
+        return sum(1 for _ in reader.iterobjects())
+    finally:
+        reader.close()
+
+def read_unpack(path):
+    return sum(1 for _ in git_parser.ObjectsIterator(path, True, True).iterobjects())
+
+def read_stream(path):
+    # Spooled, as in production, so evicted delta bases can be re-read
+    stream = packs.PackStream()
+    def feed():
+        f = open(path, 'rb')
+        try:
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                stream.feed(chunk)
+        finally:
+            f.close()
+            stream.close()
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    try:
+        count = sum(1 for _ in stream.iterobjects())
+    finally:
+        feeder.join()
+        stream.close_spool()
+        os.unlink(stream.spool_path)
+    return count
+
+def _dump_batch(path):
+    """Dump a pack's objects as cat-file --batch output, so the parsers
+    can be timed without git in the way."""
+    dump = '%s.batch' % path
+    if not os.path.exists(dump):
+        repo = os.path.dirname(os.path.dirname(os.path.dirname(path)))
+        out = open(dump, 'wb')
+        try:
+            subprocess.check_call('%s cat-file --batch-all-objects --unordered --batch' %
+                                  git_parser.GIT_CMD, shell=True, cwd=repo, stdout=out)
+        finally:
+            out.close()
+    return dump
+
+def read_batch(path):
+    f = open(_dump_batch(path), 'rb')
+    try:
+        return sum(1 for _ in git_parser.parse_batch(f))
+    finally:
+        f.close()
+
+paths = {'dulwich' : read_dulwich,
+         'reader' : read_reader,
+         'unpack' : read_unpack,
+         'stream' : read_stream,
+         'batch' : read_batch}
+
+
+## Running
+
+def _measure(path_name, pack_path):
+    """Time one parsing path over one pack.  Run in a fresh process."""
+    start = time.time()
+    count = paths[path_name](pack_path)
+    elapsed = time.time() - start
+    size = os.path.getsize(pack_path)
+    # ru_maxrss is in kilobytes on Linux
+    return {'objects' : count,
+            'seconds' : elapsed,
+            'objects_per_second' : count / elapsed,
+            'mb_per_second' : size / elapsed / (1024 * 1024),
+            'peak_rss_mb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+
+def measure(path_name, pack_path, repeat=1):
+    """Time a parsing path over a pack, keeping the fastest of repeat
+    runs."""
+    best = None
+    for _ in xrange(repeat):
+        pool = multiprocessing.Pool(1)
+        try:
+            result = pool.apply(_measure, (path_name, pack_path))
+        finally:
+            pool.terminate()
+            pool.join()
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+def run(workdir=None, scale=1, scenario_names=None, path_names=None, repeat=1):
+    """Benchmark every path over every scenario.  Returns results keyed
+    by scenario, then by path."""
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='anygit_bench_')
+    results = {}
+    try:
+        for scenario in scenario_names or sorted(scenarios):
+            logger.info('Building %s (scale %d)' % (scenario, scale))
+            pack_path = make_pack(workdir, scenario, scale)
+            results[scenario] = {}
+            for path_name in path_names or sorted(paths):
+                results[scenario][path_name] = measure(path_name, pack_path, repeat)
+                logger.info('%s/%s: %.0f objects/s' %
+                            (scenario, path_name, results[scenario][path_name]['objects_per_second']))
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def compare(results, baseline):
+    """Return (scenario, path, ratio) for every result that is more
+    than tolerance slower than the baseline.  Ratio is current
+    throughput over baseline throughput."""
+    regressions = []
+    for scenario, by_path in sorted(results.iteritems()):
+        for path_name, result in sorted(by_path.iteritems()):
+            try:
+                base = baseline[scenario][path_name]
+            except KeyError:
+                continue
+            ratio = result['objects_per_second'] / base['objects_per_second']
+            if ratio < 1 - tolerance:
+                regressions.append((scenario, path_name, ratio))
+    return regressions
+
+def format_results(results, baseline=None):
+    lines = ['%-14s %-9s %8s %12s %8s %9s %9s' %
+             ('scenario', 'path', 'objects', 'objects/s', 'MB/s', 'peak MB', 'vs base')]
+    for scenario, by_path in sorted(results.iteritems()):
+        for path_name, result in sorted(by_path.iteritems()):
+            try:
+                base = baseline[scenario][path_name]
+            except (KeyError, TypeError):
+                versus = ''
+            else:
+                versus = '%.2fx' % (result['objects_per_second'] / base['objects_per_second'])
+            lines.append('%-14s %-9s %8d %12.0f %8.1f %9.1f %9s' %
+                         (scenario, path_name, result['objects'], result['objects_per_second'],
+                          result['mb_per_second'], result['peak_rss_mb'], versus))
+    return '\n'.join(lines)
+
+def load_baseline(path):
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def save_baseline(path, results):
+    f = open(path, 'w')
+    try:
+        json.dump(results, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
@@ -1,14 +1,21 @@
 import datetime
 from dulwich import client, object_store
+import itertools
+import json
 import logging
+import marshal
 import os
 import sys
+import socket
 import tempfile
 import threading
+import time
 import traceback
+import zlib
 
-from anygit import models
-from anygit.client import git_parser
+from anygit import memory, models, stats
+from anygit.client import git_parser, packs, priority, type_map
+from anygit.client import known_objects as known_objects_module
 from anygit.data import exceptions
 
 try:
@@ -19,6 +26,48 @@ except ImportError:
 DIR = os.path.dirname(__file__)
 logger = logging.getLogger(__name__)
 timeout = 10
+# Seconds an indexer's claim on a repo lasts without a heartbeat
+lease_ttl = 600
+
+# Default limits for index_all: how many fetches may talk to one host
+# at once, and how many workers may be parsing and writing at once.
+max_fetches_per_host = 4
+max_indexers = multiprocessing.cpu_count()
+
+# How many processes to read each pack with.  index_all's workers
+# can't start processes of their own, so this only helps when indexing
+# one repo at a time.
+read_processes = 1
+
+# Whether to look up which objects in a pack are already completely
+# indexed (and so needn't be rewritten), and how many at a time.
+check_complete = True
+complete_check_window = 1000
+
+# Where to record how far indexing has got, so that a run that dies
+# can be resumed.  Set checkpoint_dir to None to disable checkpoints.
+checkpoint_dir = os.path.join(tempfile.gettempdir(), 'anygit-checkpoints')
+# Objects to process between checkpoints
+checkpoint_interval = 10000
+# Seconds after which a checkpoint (and its packs) is too old to use
+checkpoint_max_age = 24 * 60 * 60
+
+# Where each worker writes out its stats (see anygit.stats), in
+# Prometheus' text format, for node_exporter's textfile collector to
+# pick up.  Set to None to not write them.
+metrics_dir = None
+
+# A known_objects.KnownObjects of objects that needn't be rewritten.
+# Load it before forking workers, so they all share its pages.
+known_objects = None
+
+# Hosts are spread over this many semaphores by index_all, so it
+# needn't know up front which hosts it will fetch from
+host_slot_buckets = 256
+
+# Shared semaphores, set up in each index_all worker by _init_worker
+_host_slots = []
+_index_slots = None
 
 
 class Error(Exception):
@@ -33,6 +82,289 @@ class DeadRepo(Error):
     pass
 
 
+class LeaseLost(Error):
+    pass
+
+
+def lease_owner():
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+def write_metrics():
+    """Export this worker's stats to metrics_dir, if set."""
+    if not metrics_dir:
+        return
+    path = os.path.join(metrics_dir, 'anygit-%d.prom' % os.getpid())
+    try:
+        stats.write_prometheus(path, worker=lease_owner())
+    except (IOError, OSError), e:
+        logger.error('Could not write metrics to %s: %s' % (path, e))
+
+
+class Lease(object):
+    """A time-limited claim on a repo, so that only one worker (on any
+    machine) indexes it at once.  If the worker dies, the lease simply
+    expires and someone else can pick the repo up.
+
+    While held, the lease is renewed from a background thread, since
+    some phases of indexing (resolving deferred edges, index-pack,
+    marking objects complete) can outlast the ttl without calling
+    back.  heartbeat() raises LeaseLost once renewing has failed."""
+    def __init__(self, repo, ttl=None, owner=None):
+        self.repo = repo
+        self.ttl = ttl or lease_ttl
+        self.owner = owner or lease_owner()
+        self.renewed = None
+        self.lost = False
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._renewer = None
+        # Renewing from another thread mustn't touch the caller's
+        # copy of the repo, which may have unsaved changes
+        self._handle = type(repo)(id=repo.id)
+
+    def acquire(self):
+        if self.repo.acquire_lease(self.owner, self.ttl):
+            self.renewed = time.time()
+            self._renewer = threading.Thread(target=self._keep_renewed, name='lease-renewer')
+            self._renewer.daemon = True
+            self._renewer.start()
+            return True
+        return False
+
+    def heartbeat(self):
+        """Renew the lease if it's getting on.  Cheap enough to call
+        often."""
+        if self.lost:
+            raise LeaseLost('Lost our lease on %s' % self.repo)
+        if time.time() - self.renewed < self.ttl / 3:
+            return
+        self._renew()
+
+    def _renew(self):
+        with self._lock:
+            if not self._handle.renew_lease(self.owner, self.ttl):
+                self.lost = True
+                raise LeaseLost('Lost our lease on %s' % self.repo)
+            self.renewed = time.time()
+
+    def _keep_renewed(self):
+        while True:
+            self._stop.wait(self.ttl / 3.0)
+            if self._stop.isSet():
+                return
+            try:
+                self._renew()
+            except LeaseLost:
+                logger.error('Lost our lease on %s' % self.repo)
+                return
+            except Exception:
+                # Try again next time round
+                logger.exception('Could not renew our lease on %s' % self.repo)
+
+    def release(self):
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+            self._renewer = None
+        self.repo.release_lease(self.owner)
+
+
+class DeferredEdges(object):
+    """An append-only queue of edges whose child type was unknown when
+    we saw them.  Spooled to disk, since on large repos this can be
+    most of the tree entries in the pack."""
+    chunk_size = 1000
+
+    def __init__(self):
+        self._file = tempfile.TemporaryFile()
+        self._chunk = []
+        self._count = 0
+
+    def append(self, edge):
+        self._chunk.append(edge)
+        self._count += 1
+        if len(self._chunk) >= self.chunk_size:
+            self._spill()
+
+    def _spill(self):
+        marshal.dump(self._chunk, self._file)
+        self._chunk = []
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        if self._chunk:
+            self._spill()
+        self._file.flush()
+        self._file.seek(0)
+        while True:
+            try:
+                chunk = marshal.load(self._file)
+            except EOFError:
+                break
+            for edge in chunk:
+                yield edge
+        self._file.seek(0, os.SEEK_END)
+
+    def close(self):
+        self._file.close()
+
+
+class Checkpoint(object):
+    """Records how far we have got indexing a repo, so that a run that
+    dies part way through can carry on from there rather than fetching
+    and processing everything again.
+
+    The packs fetched so far are kept until the repo has been indexed.
+    The last of them is the one being processed, and its first count
+    objects are already in the database."""
+    def __init__(self, repo, state):
+        self.repo = repo
+        self.path = os.path.join(checkpoint_dir, '%s.json' % repo.id)
+        self.state = state
+        self.packs = []
+        self.count = 0
+        self.phase = 'objects'
+        # Objects come out of a pack in an order that depends on how
+        # many processes read it, so resume with as many as before
+        self.read_processes = read_processes
+
+    def load(self):
+        """Pick up the checkpoint left by a previous run, if there is a
+        usable one.  Returns whether there was."""
+        try:
+            f = open(self.path)
+        except IOError:
+            return False
+        try:
+            try:
+                data = json.load(f)
+            except ValueError, e:
+                logger.error('Corrupt checkpoint %s: %s' % (self.path, e))
+                os.unlink(self.path)
+                return False
+        finally:
+            f.close()
+        self.packs = data['packs']
+        if time.time() - data['written'] > checkpoint_max_age:
+            logger.info('Discarding stale checkpoint for %s' % self.repo)
+            self.discard()
+            return False
+        last_index = self.repo.last_index
+        if last_index and time.mktime(last_index.timetuple()) > data['written']:
+            # Someone else has indexed it since
+            logger.info('Discarding checkpoint for %s, since it has been indexed since' %
+                        self.repo)
+            self.discard()
+            return False
+        missing = [path for path in self.packs if not os.path.exists(path)]
+        if missing:
+            logger.error('Discarding checkpoint for %s, since %s have gone' % (self.repo, missing))
+            self.discard()
+            return False
+        self.count = data['count']
+        self.read_processes = data.get('read_processes', 1)
+        self.phase = data['phase']
+        self.state['retrieved'] = set(data['retrieved'])
+        if 'has_extra' in data:
+            self.state['has_extra'] = data['has_extra']
+        return True
+
+    def save(self):
+        try:
+            os.makedirs(checkpoint_dir)
+        except OSError:
+            if not os.path.isdir(checkpoint_dir):
+                raise
+        data = {'packs' : self.packs,
+                'count' : self.count,
+                'phase' : self.phase,
+                'read_processes' : self.read_processes,
+                'retrieved' : list(self.state.get('retrieved', [])),
+                'written' : time.time()}
+        if 'has_extra' in self.state:
+            data['has_extra'] = self.state['has_extra']
+        tmp = '%s~' % self.path
+        f = open(tmp, 'w')
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+        os.rename(tmp, self.path)
+
+    def start_pack(self, path):
+        """Note that we have fetched a new pack, and are about to
+        process it."""
+        self.packs.append(path)
+        self.count = 0
+        self.phase = 'objects'
+        self.read_processes = read_processes
+        self.save()
+        sweep_checkpoints()
+
+    def record(self, count, phase='objects'):
+        """Note that the first count objects of the current pack have
+        been processed.  Flushes first, so that they really are in the
+        database."""
+        models.flush()
+        self.count = count
+        self.phase = phase
+        self.save()
+
+    def discard(self):
+        for path in self.packs:
+            try:
+                os.unlink(path)
+            except OSError, e:
+                logger.error('Could not remove pack %s: %s' % (path, e))
+        self.packs = []
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def sweep_checkpoints():
+    """Remove checkpoints, and the packs kept for them, that are too old
+    to resume from.  Ones whose repo went to another worker, or that
+    were never picked up again, would otherwise stay forever."""
+    if not checkpoint_dir:
+        return
+    try:
+        names = os.listdir(checkpoint_dir)
+    except OSError:
+        return
+    cutoff = time.time() - checkpoint_max_age
+    for name in names:
+        path = os.path.join(checkpoint_dir, name)
+        try:
+            if os.path.getmtime(path) > cutoff:
+                continue
+        except OSError:
+            # Removed by someone else
+            continue
+        if name.endswith('.json'):
+            try:
+                f = open(path)
+                try:
+                    packs = json.load(f)['packs']
+                finally:
+                    f.close()
+            except (IOError, ValueError, KeyError):
+                packs = []
+            for pack_path in packs:
+                try:
+                    os.unlink(pack_path)
+                except OSError:
+                    pass
+        logger.info('Removing stale checkpoint file %s' % path)
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+
 class Checker(threading.Thread):
     valid = None
     def __init__(self, repo):
@@ -50,6 +382,65 @@ class Checker(threading.Thread):
         else:
             self.valid = True
 
+class CommitGraph(object):
+    """The ancestry of a repo's indexed commits, for the pack
+    negotiation graph walker.  Loaded in bulk the first time it's
+    needed, rather than querying for each commit walked."""
+    def __init__(self, repo):
+        self.repo = repo
+        self._parents = None
+
+    def _load(self):
+        start = time.time()
+        parents = {}
+        for commit_id, parent_id in self.repo.get_commit_graph():
+            parents.setdefault(commit_id.decode('hex'), []).append(parent_id.decode('hex'))
+        logger.info('Loaded ancestry of %d commits for %s in %.1fs' %
+                    (len(parents), self.repo, time.time() - start))
+        self._parents = parents
+
+    def get_parents(self, sha1):
+        if self._parents is None:
+            self._load()
+        return [p.encode('hex') for p in self._parents.get(sha1.decode('hex'), ())]
+
+
+class Slot(object):
+    """Holds a (possibly absent) semaphore for the duration of a with
+    block."""
+    def __init__(self, semaphore):
+        self.semaphore = semaphore
+
+    def __enter__(self):
+        if self.semaphore:
+            self.semaphore.acquire()
+
+    def __exit__(self, type, value, traceback):
+        if self.semaphore:
+            self.semaphore.release()
+
+
+class StreamIndexer(threading.Thread):
+    """Indexes a PackStream while fetch() feeds it from the network."""
+    exc_info = None
+    def __init__(self, repo, pack_stream, type_mapper, heartbeat=None):
+        super(StreamIndexer, self).__init__()
+        self.repo = repo
+        self.pack_stream = pack_stream
+        self.type_mapper = type_mapper
+        self.heartbeat = heartbeat
+
+    def run(self):
+        try:
+            # Stats are per thread, so label ours with the repo too
+            with Slot(_index_slots), stats.repo(self.repo.url), stats.timer('index.process'):
+                _process_data(self.repo, self.pack_stream,
+                              _make_progress(self.repo, self.heartbeat), self.type_mapper)
+        except:
+            self.exc_info = sys.exc_info()
+            # Keep the fetch going, so at least the spooled pack is complete
+            self.pack_stream.drain()
+
 def check_validity(repo):
     c = Checker(repo)
     c.start()
@@ -61,10 +452,14 @@ def check_validity(repo):
         return True
 
 def fetch(repo, state, recover_mode=False, discover_only=False,
-          get_count=False, packfile=None, batch=None, unpack=False):
+          get_count=False, packfile=None, batch=None, unpack=False,
+          pack_stream=None, heartbeat=None):
     """Fetch data from a remote.  If recover_mode, will fetch all data
     as if we had indexed none of it.  Otherwise will do the right thing
-    with the pack protocol.  If discover_only, will fetch no data."""
+    with the pack protocol.  If discover_only, will fetch no data.  If
+    pack_stream is given, the pack is fed to it rather than written
+    out, and the path of its spool file (if any) is returned.
+    heartbeat is called as data arrives."""
     if packfile:
         return packfile
 
@@ -106,217 +501,489 @@ def fetch(repo, state, recover_mode=False, discover_only=False,
         l.update(wants)
         return wants
 
-    def get_parents(sha1):
-        try:
-            c = models.Commit.get_by_attributes(id=sha1, dirty=False)
-        except exceptions.DoesNotExist:
-            return []
-        else:
-            return [p.id for p in c.parents if p.type == 'commit' and repo.id in p.repository_ids]
-
-    destfd, destfile_name = tempfile.mkstemp()
-    destfile = os.fdopen(destfd, 'w')
-    logger.debug('Writing to %s' % destfile_name)
+    if pack_stream:
+        destfile = None
+        destfile_name = pack_stream.spool_path
+        pack_data = pack_stream.feed
+    else:
+        destfd, destfile_name = tempfile.mkstemp()
+        destfile = os.fdopen(destfd, 'w')
+        logger.debug('Writing to %s' % destfile_name)
+        pack_data = destfile.write
+    if heartbeat:
+        write = pack_data
+        def pack_data(data):
+            heartbeat()
+            write(data)
+    # Negotiation lasts until the pack starts to arrive
+    timing = {'first_data' : None}
+    write_pack = pack_data
     def pack_data(data):
-        destfile.write(data)
+        if timing['first_data'] is None:
+            timing['first_data'] = time.time()
+        stats.incr('fetch.bytes', len(data))
+        write_pack(data)
 
     def progress(progress):
         pass
 
+    commit_graph = CommitGraph(repo)
     graph_walker = object_store.ObjectStoreGraphWalker(repo.clean_remote_heads,
-                                                       get_parents)
+                                                       commit_graph.get_parents)
     assert repo.host
     assert repo.path
     c = client.TCPGitClient(repo.host)
     try:
-        c.fetch_pack(path=repo.path,
-                     determine_wants=determine_wants,
-                     graph_walker=graph_walker,
-                     pack_data=pack_data,
-                     progress=progress)
+        with Slot(_host_slot(repo.host)):
+            started = time.time()
+            c.fetch_pack(path=repo.path,
+                         determine_wants=determine_wants,
+                         graph_walker=graph_walker,
+                         pack_data=pack_data,
+                         progress=progress)
+            finished = time.time()
+        first_data = timing['first_data'] or finished
+        stats.record_time('fetch.negotiation', first_data - started)
+        stats.record_time('fetch.transfer', finished - first_data)
     except KeyboardInterrupt:
         pass
+    except LeaseLost:
+        raise
     except Exception, e:
         logger.error('Problem when fetching %s: %s' % (repo, traceback.format_exc()))
         raise DeadRepo
-    destfile.close()
+    if destfile:
+        destfile.close()
     return destfile_name
 
-def _objectify(id, type):
-    mapper = {'blob' : models.Blob,
-              'tree' : models.Tree,
-              'commit' : models.Commit,
-              'tag' : models.Tag}
-    return mapper[type].get_from_cache_or_new(id=id)
-
-def _process_object(repo, obj, progress, type_mapper, iteration):
-    # obj is Dulwich object
-    # indexed_object will be the MongoDBModel we create
+# Edges are written with models.ingest, as (kind, key1, key2, name,
+# mode) tuples.  The kind of a tree entry, by the entry's type:
+_child_kinds = {'blob' : 'blob_trees',
+                'tree' : 'tree_parent_trees',
+                'commit' : 'commit_trees'}
+# And of a tag, by the type of what it tags:
+_tag_kinds = {'blob' : 'blob_tags',
+              'tree' : 'tree_tags',
+              'commit' : 'commit_tags',
+              'tag' : 'tag_parent_tags'}
+
+def _child_edge(parent_id, name, mode, sha1, child_type):
+    return (_child_kinds[child_type], sha1, parent_id, name, mode)
+
+def _tag_edge(tag_id, child_id, child_type):
+    return (_tag_kinds[child_type], child_id, tag_id, None, None)
+
+def _process_object(repo, obj, progress, type_mapper, deferred, complete=False):
+    """Index obj.  Returns False if it was already fully indexed
+    (complete, or a known object), in which case only its membership
+    in repo is recorded."""
+    # obj is a git_parser object; what we know about it goes to the
+    # database as models.ingest tuples
     progress(obj)
+    type_mapper[obj.sha1] = obj.type_name
+    stats.incr('index.objects')
+
+    membership = [(obj.id, obj.type_name, repo.id)]
+    if complete or (known_objects is not None and obj.sha1 in known_objects):
+        # Its edges (and so its whole subtree) are already in the database
+        stats.incr('index.skipped')
+        models.ingest(objects=membership)
+        return False
 
-    if iteration == 1:
-        if obj.type_name == 'tree':
-            indexed_object = models.Tree.get_from_cache_or_new(id=obj.id)
-        elif obj.type_name == 'commit':
-            indexed_object = models.Commit.get_from_cache_or_new(id=obj.id)
-            indexed_object.add_parents(obj.parents)
-            indexed_object.add_tree(obj.tree)
-        elif obj.type_name == 'tag':
-            indexed_object = models.Tag.get_from_cache_or_new(id=obj.id)
+    # Children usually come after their parents in a pack, so we
+    # generally don't know their type yet.  Emit what we can now and
+    # leave the rest for the fixup pass.
+    edges = []
+    if obj.type_name == 'tree':
+        for name, mode, sha1 in obj.iteritems():
+            child_type = type_mapper.get(sha1)
+            if child_type is None:
+                deferred.append((obj.id, name, mode, sha1))
+            else:
+                edges.append(_child_edge(obj.id, name, mode, sha1, child_type))
+    elif obj.type_name == 'commit':
+        for parent_id in set(obj.parents):
+            edges.append(('commit_parent_commits', obj.id, parent_id, None, None))
+        edges.append(('tree_commits', obj.tree, obj.id, None, None))
+    elif obj.type_name == 'tag':
+        # In dulwich, first entry is the child object.  In our custom parser,
+        # it's None.
+        _, child_id = obj.object
+        child_type = type_mapper.get(child_id)
+        if child_type is None:
+            deferred.append((obj.id, None, None, child_id))
         else:
-            assert obj.type_name == 'blob'
-            indexed_object = models.Blob.get_from_cache_or_new(id=obj.id)
-        indexed_object.save()
-        indexed_object.add_repository(repo)
-    else:
-        if obj.type_name == 'tree':
-            for name, mode, sha1 in obj.iteritems():
-                # Default the type of the child object to a commit (a submodule)
-                child_type = type_mapper.setdefault(sha1, 'commit')
-                if child_type == 'tree':
-                    child = models.Tree.get_from_cache_or_new(id=sha1)
-                    child.add_parent(obj.id, name=name, mode=mode)
-                elif child_type == 'blob':
-                    child = models.Blob.get_from_cache_or_new(id=sha1)
-                    child.add_parent(obj.id, name=name, mode=mode)
-                else:
-                    assert child_type == 'commit'
-                    child = models.Commit.get_from_cache_or_new(id=sha1)
-                    child.add_as_submodule_of(obj.id, name=name, mode=mode)
-        elif obj.type_name == 'tag':
-            # In dulwich, first entry is the child object.  In our custom parser,
-            # it's None.
-            _, child_id = obj.object
-            child_type = type_mapper[child_id]
-            child = _objectify(id=child_id, type=child_type)
-            child.add_tag(obj.id)
+            edges.append(_tag_edge(obj.id, child_id, child_type))
+    stats.incr('index.edges', len(edges))
+    models.ingest(edges, membership)
+    return True
+
+def _replay_object(obj, progress, type_mapper, deferred):
+    """Rebuild the in-memory state processing obj left behind in a
+    previous run, without writing anything."""
+    progress(obj)
+    type_mapper[obj.sha1] = obj.type_name
+    if obj.type_name == 'tree':
+        for name, mode, sha1 in obj.iteritems():
+            if sha1 not in type_mapper:
+                deferred.append((obj.id, name, mode, sha1))
+    elif obj.type_name == 'tag':
+        _, child_id = obj.object
+        if child_id not in type_mapper:
+            deferred.append((obj.id, None, None, child_id))
+
+def _load_types(path, type_mapper, unpack=False):
+    """Fill in type_mapper from a pack that has already been indexed."""
+    for obj in git_parser.ObjectsIterator(path, True, unpack).iterobjects():
+        type_mapper[obj.sha1] = obj.type_name
+
+def _process_deferred(repo, type_mapper, deferred):
+    logger.info('Resolving %d deferred edges for %s' % (len(deferred), repo))
+    models.ingest(_resolve_deferred(type_mapper, deferred))
+    stats.incr('index.edges', len(deferred))
+
+def _resolve_deferred(type_mapper, deferred):
+    for parent_id, name, mode, sha1 in deferred:
+        if mode is None:
+            # A tag.  Its target must be in the type map by now.
+            yield _tag_edge(parent_id, sha1, type_mapper[sha1])
         else:
-            # Nothing to do for these.
-            assert obj.type_name == 'blob' or obj.type_name == 'commit'
-
-def _process_data(repo, uncompressed_pack, progress):
-    logger.info('Creating objects for %s' % repo)
-    type_mapper = {}
-    for obj in uncompressed_pack.iterobjects():
-        type_mapper[obj.id] = obj.type_name
-        _process_object(repo=repo,
-                        obj=obj,
-                        progress=progress,
-                        type_mapper=None,
-                        iteration=1)
-    logger.info('Constructed object type map of size %s (%d bytes) for %s' %
-                (len(type_mapper), type_mapper.__sizeof__(), repo))
-
-    logger.info('Now processing objects for %s' % repo)
-    for obj in uncompressed_pack.iterobjects():
-        _process_object(repo=repo,
-                        obj=obj,
-                        progress=progress,
-                        type_mapper=type_mapper,
-                        iteration=2)
-
-def index_data(data, repo, is_path=False, unpack=False):
-    if is_path:
-        empty = not os.path.getsize(data)
+            # Default the type of the child object to a commit (a submodule)
+            child_type = type_mapper.setdefault(sha1, 'commit')
+            yield _child_edge(parent_id, name, mode, sha1, child_type)
+
+def _with_completeness(objects):
+    """Yield (object, complete) pairs, looking up whether objects have
+    already been fully indexed a window at a time."""
+    window = []
+    for obj in objects:
+        window.append(obj)
+        if len(window) >= complete_check_window:
+            for pair in _check_complete(window):
+                yield pair
+            window = []
+    for pair in _check_complete(window):
+        yield pair
+
+def _check_complete(window):
+    # No need to ask about objects the known objects filter covers
+    if known_objects is not None:
+        ids = [obj.id for obj in window if obj.sha1 not in known_objects]
     else:
-        empty = data
+        ids = [obj.id for obj in window]
+    complete = models.GitObject.find_complete(ids)
+    return [(obj, obj.id in complete) for obj in window]
+
+def _process_data(repo, uncompressed_pack, progress, type_mapper, checkpoint=None, resume_from=0):
+    """Index every object in uncompressed_pack.  The first resume_from
+    objects were processed by an earlier run, so are only replayed."""
+    logger.info('Processing objects for %s' % repo)
+    deferred = DeferredEdges()
+    skipped = 0
+    # Time spent waiting on the pack is the time spent parsing it
+    objects = stats.timed('index.parse', uncompressed_pack.iterobjects())
+    if resume_from:
+        logger.info('Replaying %d objects already processed for %s' % (resume_from, repo))
+        for obj in itertools.islice(objects, resume_from):
+            _replay_object(obj, progress, type_mapper, deferred)
+    if check_complete:
+        objects = _with_completeness(objects)
+    else:
+        objects = ((obj, False) for obj in objects)
+    memory.register('type_map_bytes', type_mapper.memory_usage, type_mapper.spill)
+    try:
+        for obj, complete in objects:
+            if not _process_object(repo=repo,
+                                   obj=obj,
+                                   progress=progress,
+                                   type_mapper=type_mapper,
+                                   deferred=deferred,
+                                   complete=complete):
+                skipped += 1
+        if skipped:
+            logger.info('Skipped %d already indexed objects for %s' % (skipped, repo))
+        logger.info('Object type map has %d entries (%d bytes in memory) for %s' %
+                    (len(type_mapper), type_mapper.memory_usage(), repo))
+        if checkpoint:
+            checkpoint.record(progress.count(), phase='deferred')
+        _process_deferred(repo, type_mapper, deferred)
+    finally:
+        memory.unregister('type_map_bytes')
+        deferred.close()
 
-    if empty:
-        logger.info('No data to index')
-        return
-    objects_iterator = git_parser.ObjectsIterator(data, is_path, unpack)
+def _make_progress(repo, heartbeat=None, checkpoint=None):
     counter = {'count' : 0}
     def progress(object):
+        # Everything before this object has been processed
+        done = counter['count']
         counter['count'] += 1
+        if checkpoint and done > checkpoint.count and not done % checkpoint_interval:
+            checkpoint.record(done)
+        if heartbeat and not counter['count'] % 1000:
+            heartbeat()
+        if memory.enabled and not counter['count'] % memory.sample_interval:
+            memory.sample()
         if not counter['count'] % 10000:
             check_for_die_file()
+            write_metrics()
             logger.info('About to process object %d for %s (object is %s %s)' % (counter['count'],
                                                                                  repo,
                                                                                  object.type_name,
                                                                                  object.id))
-    _process_data(repo, objects_iterator, progress)
+    progress.count = lambda: counter['count']
+    return progress
+
+def stream_and_index(repo, state, type_mapper, spool=True, heartbeat=None, **kwargs):
+    """Fetch from repo, indexing objects as they arrive rather than
+    once the whole pack is down.  Returns the path of the spooled
+    pack, or None if spool is False."""
+    pack_stream = packs.PackStream(spool=spool)
+    # Only the indexer thread heartbeats, so the database is only ever
+    # used from one thread at a time.
+    indexer = StreamIndexer(repo, pack_stream, type_mapper, heartbeat)
+    # The indexer only touches the database once pack data starts to
+    # arrive, by which point fetch() is done with its own queries.
+    indexer.start()
+    try:
+        fetch(repo, state=state, pack_stream=pack_stream, **kwargs)
+    except:
+        pack_stream.close()
+        indexer.join()
+        pack_stream.close_spool()
+        if pack_stream.spool_path:
+            os.unlink(pack_stream.spool_path)
+        raise
+    pack_stream.close()
+    indexer.join()
+    pack_stream.close_spool()
+    if indexer.exc_info:
+        type, value, tb = indexer.exc_info
+        if isinstance(value, packs.UnresolvableDelta) and pack_stream.spool_path:
+            logger.warning('Could not stream %s (%s); indexing the spooled pack instead' %
+                           (repo, value))
+            index_data(pack_stream.spool_path, repo, is_path=True,
+                       type_mapper=type_mapper, heartbeat=heartbeat)
+        else:
+            if pack_stream.spool_path:
+                os.unlink(pack_stream.spool_path)
+            raise type, value, tb
+    return pack_stream.spool_path
+
+def index_data(data, repo, is_path=False, unpack=False, type_mapper=None, heartbeat=None,
+               checkpoint=None, resume_from=0):
+    """Index the given pack.  Pass in a type_mapper to share object
+    types with previous packs from the same repo.  If a checkpoint is
+    given, progress is recorded in it; resume_from is the number of
+    objects a previous run got through."""
+    if is_path:
+        empty = not os.path.getsize(data)
+    else:
+        empty = data
+
+    if empty:
+        logger.info('No data to index')
+        return
+    if checkpoint is None:
+        processes = read_processes
+    else:
+        processes = checkpoint.read_processes
+    objects_iterator = git_parser.ObjectsIterator(data, is_path, unpack,
+                                                  processes=processes)
+    progress = _make_progress(repo, heartbeat, checkpoint)
+    if type_mapper is None:
+        local_type_mapper = type_map.ObjectTypeMap()
+    else:
+        local_type_mapper = type_mapper
+    try:
+        with Slot(_index_slots), stats.timer('index.process'):
+            _process_data(repo, objects_iterator, progress, local_type_mapper,
+                          checkpoint=checkpoint, resume_from=resume_from)
+    finally:
+        if type_mapper is None:
+            local_type_mapper.close()
 
-def fetch_and_index(repo, recover_mode=False, packfile=None, batch=None, unpack=False):
+def fetch_and_index(repo, recover_mode=False, packfile=None, batch=None, unpack=False,
+                    stream=False, spool=True):
     check_for_die_file()
     if isinstance(repo, basestring):
         repo = models.Repository.get(repo)
+    try:
+        with stats.repo(repo.url), memory.track(repo):
+            _fetch_and_index(repo, recover_mode=recover_mode, packfile=packfile, batch=batch,
+                             unpack=unpack, stream=stream, spool=spool)
+    finally:
+        write_metrics()
+
+def _fetch_and_index(repo, recover_mode, packfile, batch, unpack, stream, spool):
     repo.refresh()
-    # There's a race condition here where two indexing processes might
-    # try to index the same repo.  However, since it's idempotent,
-    # this is not harmful beyond wasting resources.  However, we check
-    # here to try to minimize the damage.
-    if repo.indexing:
+    lease = Lease(repo)
+    if not lease.acquire():
         logger.error('Repo is already being indexed')
         return
     logger.info('Beginning to index: %s' % repo)
     now = datetime.datetime.now()
+    start = time.time()
     data_path = None
+    # Shared across batches, since later batches may refer to objects
+    # from earlier ones.
+    type_mapper = type_map.ObjectTypeMap()
+    state = {}
+    # Streamed packs can't be resumed part way through, so don't bother
+    # checkpointing them.
+    if checkpoint_dir and not packfile and not stream:
+        checkpoint = Checkpoint(repo, state)
+        resuming = checkpoint.load()
+    else:
+        checkpoint = None
+        resuming = False
+    finished = False
+    lease_lost = False
 
     try:
-        # Don't let other people try to index in parallel
-        repo.indexing = True
         repo.dirty = True
         repo.save()
         models.flush()
-        state = {}
+        if resuming:
+            logger.info('Resuming %s at object %d of %s (%s phase)' %
+                        (repo, checkpoint.count, checkpoint.packs[-1], checkpoint.phase))
+            for path in checkpoint.packs[:-1]:
+                _load_types(path, type_mapper, unpack=unpack)
         while True:
-            data_path = fetch(repo, recover_mode=recover_mode,
-                              packfile=packfile, batch=batch, state=state)
-            index_data(data_path, repo, is_path=True, unpack=unpack)
+            if resuming:
+                data_path = checkpoint.packs[-1]
+                index_data(data_path, repo, is_path=True, unpack=unpack,
+                           type_mapper=type_mapper, heartbeat=lease.heartbeat,
+                           checkpoint=checkpoint, resume_from=checkpoint.count)
+                resuming = False
+            elif stream and not packfile:
+                data_path = stream_and_index(repo, state=state, type_mapper=type_mapper,
+                                             spool=spool, heartbeat=lease.heartbeat,
+                                             recover_mode=recover_mode, batch=batch)
+            else:
+                data_path = fetch(repo, recover_mode=recover_mode,
+                                  packfile=packfile, batch=batch, state=state,
+                                  heartbeat=lease.heartbeat)
+                if checkpoint:
+                    checkpoint.start_pack(data_path)
+                index_data(data_path, repo, is_path=True, unpack=unpack,
+                           type_mapper=type_mapper, heartbeat=lease.heartbeat,
+                           checkpoint=checkpoint)
             if not state.get('has_extra'):
                 break
             else:
                 logger.info('Still more remote heads, running again...')
+        models.flush()
+        repo.mark_objects_complete()
         repo.count = repo.count_objects()
         repo.last_index = now
         repo.been_indexed = True
         repo.approved = True
         repo.dirty = False
+        new_heads = set(repo.new_remote_heads or []) - set([''])
+        if new_heads != set(repo.remote_heads or []) - set(['']):
+            repo.last_changed = now
+        repo.index_duration = time.time() - start
+        repo.next_index = priority.next_index(repo, now)
         # Finally, clobber the old remote heads.
         repo.set_remote_heads(repo.new_remote_heads)
         repo.set_new_remote_heads([])
         repo.save()
         refresh_all_counts(all=False)
+        finished = True
     except DeadRepo:
         logger.error('Marking %s as dead' % repo)
         repo.approved = 0
         repo.save()
+        finished = True
     except KeyboardInterrupt:
         logger.info('^C pushed; exiting thread')
         raise
+    except LeaseLost:
+        # Whoever has the repo now will index it from scratch
+        logger.error('Lost our lease on %s; giving up' % repo)
+        lease_lost = True
     except Exception, e:
         logger.error('Had a problem indexing %s: %s' % (repo, traceback.format_exc()))
+        repo.next_index = priority.retry_at(now)
     finally:
-        repo.indexing = False
+        type_mapper.close()
         repo.save()
-        if not packfile and data_path:
+        if checkpoint:
+            if finished or lease_lost:
+                checkpoint.discard()
+            elif checkpoint.packs:
+                logger.info('Keeping %s to resume %s from' % (checkpoint.path, repo))
+        elif not packfile and data_path:
             try:
                 os.unlink(data_path)
             except IOError, e:
                 logger.error('Could not remove tmpfile %s.: %s' % (data_path, e))
         models.flush()
-    logger.info('Done with %s' % repo)
+        lease.release()
+    logger.info('Done with %s: %s' % (repo, stats.summary(stats.snapshot(repo.url))))
+
+def load_known_objects(path):
+    global known_objects
+    if known_objects is not None:
+        known_objects.close()
+    known_objects = known_objects_module.KnownObjects(path)
+
+def build_known_objects(path):
+    return known_objects_module.build(path, models.GitObject.iter_indexed_ids())
+
+def _init_worker(host_slots, index_slots):
+    global _host_slots, _index_slots
+    _host_slots = host_slots
+    _index_slots = index_slots
+
+def _host_slot(host):
+    if not _host_slots:
+        return None
+    return _host_slots[zlib.crc32(host) % len(_host_slots)]
+
+def index_queue(approved=None):
+    """Index repos in order of priority until none are due."""
+    owner = lease_owner()
+    while True:
+        check_for_die_file()
+        repo = models.Repository.pop_next(owner, lease_ttl, approved=approved)
+        if repo is None:
+            logger.info('No more repos due for indexing')
+            return
+        fetch_and_index(repo)
 
-def fetch_and_index_threaded(repo):
+def index_queue_threaded(approved=None):
     models.setup()
     try:
-        return fetch_and_index(repo)
+        return index_queue(approved)
     except DieFile:
-        # TODO: do something to terminate the controller process too
-        sys.exit(1)
+        return
     except:
         logger.error(traceback.format_exc())
         raise
 
-def index_all(last_index=None, threads=1, approved=None):
-    repos = models.Repository.get_indexed_before(last_index, approved=approved)
-    logger.info('About to index %d repos' % repos.count())
+def index_all(threads=1, approved=None, per_host=None, indexers=None):
+    """Index all repos due for indexing, most overdue first.  threads
+    is the number of workers, which mostly spend their time waiting on
+    the network.  At most per_host of them fetch from any given host
+    at once, and at most indexers of them parse and write to the
+    database at once."""
+    sweep_checkpoints()
     if threads > 1:
-        repo_ids = [r.id for r in repos]
-        pool = multiprocessing.Pool(threads)
-        pool.map(fetch_and_index_threaded, repo_ids)
+        per_host = per_host or max_fetches_per_host
+        indexers = indexers or max_indexers
+        host_slots = [multiprocessing.BoundedSemaphore(per_host)
+                      for _ in xrange(host_slot_buckets)]
+        index_slots = multiprocessing.BoundedSemaphore(indexers)
+        logger.info('Fetching with %d workers (%d per host), indexing %d at a time' %
+                    (threads, per_host, indexers))
+        pool = multiprocessing.Pool(threads, _init_worker, (host_slots, index_slots))
+        # Each worker pulls repos off the queue until it's empty
+        pool.map(index_queue_threaded, [approved] * threads, 1)
+        pool.close()
+        pool.join()
     else:
-        [fetch_and_index(repo) for repo in repos]
+        index_queue(approved)
 
 def check_for_die_file():
     if os.path.exists(os.path.join(DIR, 'die')):
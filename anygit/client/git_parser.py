@@ -1,5 +1,7 @@
 #!/usr/bin/python
+import binascii
 import os
+import shutil
 import subprocess
 import sys
 import tempfile
@@ -8,47 +10,99 @@ from dulwich import pack
 
 DIR = os.path.abspath(os.path.dirname(__file__))
 UNPACK_DIR = os.path.join(DIR, '../../tmp/unpack')
-GIT_CMD = os.path.join(DIR, '../../pkgs/git/git')
-
-types = {'t' : 'tree', 'b' : 'blob', 'c' : 'commit', 'a' : 'tag'}
-
-class Finished(Exception):
-    pass
+# Needs git 2.6 or later, for cat-file --batch-all-objects
+GIT_CMD = 'git'
 
 
 class ObjectsIterator(object):
-    def __init__(self, data, is_path, unpack):
+    def __init__(self, data, is_path, unpack, processes=None):
         if not is_path:
             assert not unpack
         self.data = data
         self.is_path = is_path
         self.unpack = unpack
+        # How many processes to read a pack on disk with
+        self.processes = processes
 
-        if not unpack:
-            if is_path:
-                pack_data = pack.PackData.from_path(data)
-            else:
-                file = StringIO.StringIO(data)
-                length = len(data)
-                pack_data = pack.PackData.from_file(file, length)
+        # Packs on disk are read with packs.PackReader
+        if not unpack and not is_path:
+            file = StringIO.StringIO(data)
+            length = len(data)
+            pack_data = pack.PackData.from_file(file, length)
             self.uncompressed_pack = pack.Pack.from_objects(pack_data, None)
 
     def iterobjects(self):
         if self.unpack:
-            # Initialize a new repo and unpack into there.  Should use our
-            # patched unpacker, which prints out parseable data.  For best
-            # performance, make UNPACK_DIR be on a tmpfs.
             assert self.is_path
-            unpack_dir = tempfile.mkdtemp(prefix='unpack_', suffix='.git', dir=UNPACK_DIR)
-            subprocess.check_call([GIT_CMD, 'init', '--bare', unpack_dir])
-            p = subprocess.Popen([GIT_CMD, 'unpack-objects'],
-                                 cwd=unpack_dir,
-                                 stdin=file(self.data),
-                                 stdout=subprocess.PIPE)
-            return parse(p.stdout)
+            return self._unpack()
+        elif self.is_path:
+            return self._read_pack()
         else:
             return (wrap_dulwich_object(obj) for obj in self.uncompressed_pack.iterobjects())
 
+    def _unpack(self):
+        """Have git read the pack for us.  The pack is linked into a
+        scratch repo and indexed there, and its objects dumped with
+        cat-file, so nothing is written out as loose objects.  The
+        scratch repo is removed afterwards.  For best performance, make
+        UNPACK_DIR be on a tmpfs."""
+        if os.path.isdir(UNPACK_DIR):
+            unpack_dir = tempfile.mkdtemp(prefix='unpack_', suffix='.git', dir=UNPACK_DIR)
+        else:
+            unpack_dir = tempfile.mkdtemp(prefix='unpack_', suffix='.git')
+        devnull = open(os.devnull, 'w')
+        try:
+            subprocess.check_call([GIT_CMD, 'init', '--quiet', '--bare', unpack_dir])
+            pack_path = os.path.join(unpack_dir, 'objects', 'pack', 'pack-anygit.pack')
+            os.symlink(os.path.abspath(self.data), pack_path)
+            subprocess.check_call([GIT_CMD, 'index-pack', pack_path], stdout=devnull)
+
+            # Blobs are done with once we know they exist.  Everything
+            # else we need the contents of.
+            wanted = tempfile.TemporaryFile()
+            command = [GIT_CMD, 'cat-file', '--batch-all-objects', '--unordered',
+                       '--batch-check=%(objectname) %(objecttype)']
+            check = subprocess.Popen(command,
+                                     cwd=unpack_dir,
+                                     stdout=subprocess.PIPE)
+            for line in check.stdout:
+                sha1, type = line.split()
+                if type == 'blob':
+                    yield Blob(sha1)
+                else:
+                    wanted.write(sha1 + '\n')
+            _wait(check, command)
+            wanted.seek(0)
+            command = [GIT_CMD, 'cat-file', '--batch']
+            batch = subprocess.Popen(command,
+                                     cwd=unpack_dir,
+                                     stdin=wanted,
+                                     stdout=subprocess.PIPE)
+            for obj in parse_batch(batch.stdout):
+                yield obj
+            _wait(batch, command)
+        finally:
+            devnull.close()
+            shutil.rmtree(unpack_dir, ignore_errors=True)
+
+    def _read_pack(self):
+        # packs imports us
+        from anygit.client import packs
+        reader = packs.PackReader(self.data)
+        try:
+            if self.processes > 1:
+                objects = reader.iterobjects_parallel(self.processes)
+            else:
+                objects = reader.iterobjects()
+            for obj in objects:
+                yield obj
+        finally:
+            reader.close()
+
+def _wait(process, command):
+    if process.wait():
+        raise subprocess.CalledProcessError(process.returncode, command)
+
 def wrap_dulwich_object(obj):
     try:
         type = obj._type
@@ -57,7 +111,7 @@ def wrap_dulwich_object(obj):
         return obj
     else:
         if type == 'tree':
-            return Tree(obj.id, obj.iteritems())
+            return Tree.from_entries(obj.id, obj.iteritems())
         elif type == 'tag':
             # Name used to be get_object, now is a property object.
             return Tag(obj.id, obj.get_object()[1])
@@ -67,32 +121,69 @@ def wrap_dulwich_object(obj):
             assert type == 'blob'
             return Blob(obj.id)
 
+def to_binary(sha1):
+    """Return the binary form of a hex or binary sha1."""
+    if len(sha1) == 40:
+        return binascii.unhexlify(sha1)
+    assert len(sha1) == 20
+    return sha1
+
 class GitObject(object):
-    """A git object, copying the interface of dulwich objects."""
+    """A git object, copying the interface of dulwich objects.  There
+    are millions of these in flight, so they have slots and keep sha1s
+    in binary, hex-encoding them only on request."""
+    __slots__ = ('sha1',)
+
     def __init__(self, id):
-        self.id = id
+        self.sha1 = to_binary(id)
+
+    @property
+    def id(self):
+        return binascii.hexlify(self.sha1)
+
+    def __reduce__(self):
+        return (type(self), (self.sha1,))
 
     def __str__(self):
         return '%s: %s' % (type(self).__name__, self.id)
 
 
 class Tree(GitObject):
+    """Entries are kept as the raw tree, and parsed as they're
+    iterated over."""
+    __slots__ = ('data',)
     type_name = 'tree'
 
-    def __init__(self, id, children):
+    def __init__(self, id, data):
         super(Tree, self).__init__(id)
-        self.children = children
+        self.data = data
+
+    @classmethod
+    def from_entries(cls, id, entries):
+        return cls(id, ''.join('%o %s\0%s' % (mode, name, to_binary(sha1))
+                               for name, mode, sha1 in entries))
+
+    def __reduce__(self):
+        return (Tree, (self.sha1, self.data))
 
     def iteritems(self):
-        return iter(self.children)
+        return iter_tree(self.data)
 
 
 class Tag(GitObject):
+    __slots__ = ('child_binary_sha1',)
     type_name = 'tag'
 
     def __init__(self, id, child_sha1):
         super(Tag, self).__init__(id)
-        self.child_sha1 = child_sha1
+        self.child_binary_sha1 = to_binary(child_sha1)
+
+    def __reduce__(self):
+        return (Tag, (self.sha1, self.child_binary_sha1))
+
+    @property
+    def child_sha1(self):
+        return binascii.hexlify(self.child_binary_sha1)
 
     @property
     def object(self):
@@ -100,90 +191,157 @@ class Tag(GitObject):
 
 
 class Commit(GitObject):
+    __slots__ = ('tree_binary_sha1', 'parent_binary_sha1s')
     type_name = 'commit'
 
     def __init__(self, id, tree, parents):
         super(Commit, self).__init__(id)
-        self.tree = tree
-        self.parents = parents
+        self.tree_binary_sha1 = to_binary(tree)
+        self.parent_binary_sha1s = tuple(to_binary(parent) for parent in parents)
+
+    def __reduce__(self):
+        return (Commit, (self.sha1, self.tree_binary_sha1, self.parent_binary_sha1s))
+
+    @property
+    def tree(self):
+        return binascii.hexlify(self.tree_binary_sha1)
+
+    @property
+    def parents(self):
+        return [binascii.hexlify(parent) for parent in self.parent_binary_sha1s]
 
 
 class Blob(GitObject):
-    type_name = 'blob'    
-
-def get_next_len(f):
-    t = f.read(1)
-    if not t:
-        raise Finished
-    type = types[t]
-    space = f.read(1)
-    assert space == ' '
-    accum = 0
-    while True:
-        n = f.read(1)
-        if n != '\0':
-            accum = int(n) + 10 * accum
-        else:
-            break
-    return type, accum
+    __slots__ = ()
+    type_name = 'blob'
 
-def null_split(s):
-    for i, char in enumerate(s):
-        if char == '\0':
-            return s[:i], s[i+1:]
-    else:
-        raise ValueError('No null byte found in %s' % s)
+# Bytes to read from a stream at a time
+read_chunk_size = 1024 * 1024
 
-def grab_sha1(s, encoded=False):
-    if encoded:
-        return s[:40], s[40:]
-    else:
-        return s[:20].encode('hex'), s[20:]
 
-def grab_mode(s):
-    return s[:5], s[6:]
+class StreamBuffer(object):
+    """Reads a stream in large chunks into a reusable buffer, so that
+    parsing can walk it with offsets rather than slicing off strings.
+    Bytes from pos to end are buffered and not yet consumed."""
+    def __init__(self, f, chunk_size=None):
+        self.f = f
+        self.buf = bytearray(chunk_size or read_chunk_size)
+        self.pos = 0
+        self.end = 0
 
-def parse(f):
-    try:
+    def fill(self, n):
+        """Make sure at least n bytes are buffered.  Returns False if
+        the stream ends first."""
+        while self.end - self.pos < n:
+            if self.pos:
+                # Move the leftovers to the front to make room
+                remaining = self.end - self.pos
+                self.buf[:remaining] = self.buf[self.pos:self.end]
+                self.pos = 0
+                self.end = remaining
+            if n > len(self.buf):
+                self.buf.extend(bytearray(max(n, 2 * len(self.buf)) - len(self.buf)))
+            read = self.f.readinto(memoryview(self.buf)[self.end:])
+            if not read:
+                return False
+            self.end += read
+        return True
+
+    def find(self, char):
+        """Return the offset of the next char, buffering as much as it
+        takes to find it."""
+        # Bytes past pos already searched.  Filling may move pos.
+        searched = 0
         while True:
-            type, accum = get_next_len(f)
-            sha1 = f.read(20).encode('hex')
-            if type == 'tree':
-                data = f.read(accum)
-                children = []
-                while data:
-                    mode, data = grab_mode(data)
-                    filename, data = null_split(data)
-                    child_sha1, data = grab_sha1(data, encoded=False)
-                    children.append((filename, mode, child_sha1))
-                yield Tree(sha1, children)
-            elif type == 'tag':
-                data = f.read(accum)
-                assert data[:7] == 'object '
-                child_sha1, _ = grab_sha1(data[7:], encoded=True)
-                yield Tag(sha1, child_sha1)
-            elif type == 'commit':
-                tree = None
-                parents = []
-                data = f.read(accum)
-                while data[:6] != 'author':
-                    if data[:5] == 'tree ':
-                        assert tree is None
-                        tree, data = grab_sha1(data[5:], encoded=True)
-                    else:
-                        assert data[:7] == 'parent '
-                        child_sha1, data = grab_sha1(data[7:], encoded=True)
-                        parents.append(child_sha1)
-                    # Slurp a newline
-                    assert data[0] == '\n'
-                    data = data[1:]
-                yield Commit(sha1, tree, parents)
-            else:
-                assert type == 'blob'
-                yield Blob(sha1)
-    except Finished:
-        print 'Completed'
+            i = self.buf.find(char, self.pos + searched, self.end)
+            if i != -1:
+                return i
+            searched = self.end - self.pos
+            if not self.fill(searched + 1):
+                raise ValueError('Stream ended looking for %r' % char)
+
+
+def parse_tree(data, start=0, end=None):
+    return list(iter_tree(data, start, end))
+
+def iter_tree(data, start=0, end=None):
+    """Yield (filename, mode, sha1) for each entry in the raw tree in
+    data[start:end], which may be a str or a bytearray.  Walks it by
+    offset, so is linear in its size."""
+    if end is None:
+        end = len(data)
+    pos = start
+    while pos < end:
+        space = data.find(' ', pos, end)
+        null = data.find('\0', space, end)
+        if space == -1 or null == -1:
+            raise ValueError('Malformed tree entry at offset %d' % pos)
+        mode = int(str(data[pos:space]), 8)
+        filename = str(data[space + 1:null])
+        child_sha1 = binascii.hexlify(data[null + 1:null + 21])
+        yield filename, mode, child_sha1
+        pos = null + 21
+
+def parse_tag(data, start=0, end=None):
+    assert data.startswith('object ', start)
+    return str(data[start + 7:start + 47])
+
+def parse_commit(data, start=0, end=None):
+    if end is None:
+        end = len(data)
+    tree = None
+    parents = []
+    pos = start
+    while not data.startswith('author', pos):
+        if data.startswith('tree ', pos):
+            assert tree is None
+            tree = str(data[pos + 5:pos + 45])
+            pos += 45
+        else:
+            assert data.startswith('parent ', pos)
+            parents.append(str(data[pos + 7:pos + 47]))
+            pos += 47
+        # Slurp a newline
+        assert data[pos] in ('\n', ord('\n'))
+        pos += 1
+        if pos >= end:
+            raise ValueError('Commit has no author')
+    return tree, parents
+
+def make_object(type, sha1, data, start=0, end=None):
+    """Build the record for an object from its raw contents, found in
+    data[start:end]."""
+    if type == 'tree':
+        if end is None:
+            end = len(data)
+        # Keep our own copy, as data may be a buffer that gets reused
+        return Tree(sha1, str(data[start:end]))
+    elif type == 'tag':
+        return Tag(sha1, parse_tag(data, start, end))
+    elif type == 'commit':
+        tree, parents = parse_commit(data, start, end)
+        return Commit(sha1, tree, parents)
+    else:
+        assert type == 'blob'
+        return Blob(sha1)
+
+def parse_batch(f):
+    """Parse the output of git cat-file --batch."""
+    stream = StreamBuffer(f)
+    while stream.fill(1):
+        newline = stream.find('\n')
+        header = str(stream.buf[stream.pos:newline]).split()
+        if header[1] == 'missing':
+            raise ValueError('git is missing object %s' % header[0])
+        sha1, type, length = header
+        length = int(length)
+        stream.pos = newline + 1
+        # Contents are followed by a newline
+        if not stream.fill(length + 1):
+            raise ValueError('Stream ended in the middle of %s %s' % (type, sha1))
+        yield make_object(type, sha1, stream.buf, stream.pos, stream.pos + length)
+        stream.pos += length + 1
 
 if __name__ == '__main__':
-    for type, sha1, extra in parse(sys.stdin):
-        print type, sha1, extra
+    for obj in parse_batch(sys.stdin):
+        print obj
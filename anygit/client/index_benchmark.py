@@ -0,0 +1,163 @@
+"""End-to-end indexing benchmarks.
+
+Synthetic repos (see anygit.client.benchmark) are served by a local git
+daemon, and indexed with fetch_and_index or index_all into whatever
+database is configured, which should be a local, disposable one.
+fetch_and_index runs are broken down by phase from anygit.stats."""
+import logging
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+from anygit import models, stats
+from anygit.client import benchmark, fetch, git_parser
+
+logger = logging.getLogger(__name__)
+
+# Repo URLs don't carry a port, so the daemon has to use git's own
+daemon_host = '127.0.0.1'
+daemon_port = 9418
+# Seconds to wait for the daemon to start listening
+daemon_timeout = 10
+
+
+class Daemon(object):
+    """A git daemon serving every repo under base_path."""
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.process = None
+
+    def start(self):
+        self.process = subprocess.Popen([git_parser.GIT_CMD, 'daemon', '--export-all',
+                                         '--reuseaddr',
+                                         '--listen=%s' % daemon_host,
+                                         '--port=%d' % daemon_port,
+                                         '--base-path=%s' % self.base_path,
+                                         self.base_path])
+        deadline = time.time() + daemon_timeout
+        while True:
+            try:
+                socket.create_connection((daemon_host, daemon_port), 1).close()
+            except socket.error:
+                if self.process.poll() is not None or time.time() > deadline:
+                    self.stop()
+                    raise RuntimeError('git daemon did not start on port %d' % daemon_port)
+                time.sleep(0.1)
+            else:
+                return
+
+    def stop(self):
+        if self.process and self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+        self.process = None
+
+    def url(self, name):
+        return 'git://%s/%s' % (daemon_host, name)
+
+
+def _phases(snapshot, wall):
+    seconds = stats.seconds
+    objects = snapshot['counters'].get('index.objects', 0)
+    return {'wall' : wall,
+            'negotiation' : seconds(snapshot, 'fetch.negotiation'),
+            'transfer' : seconds(snapshot, 'fetch.transfer'),
+            'parse' : seconds(snapshot, 'index.parse'),
+            # Processing the pack, less parsing and the flushes done
+            # along the way
+            'process' : seconds(snapshot, 'index.process', own=True),
+            'flush' : seconds(snapshot, 'db.flush'),
+            'bytes' : snapshot['counters'].get('fetch.bytes', 0),
+            'objects' : objects,
+            'edges' : snapshot['counters'].get('index.edges', 0),
+            'skipped' : snapshot['counters'].get('index.skipped', 0),
+            'db_operations' : snapshot['counters'].get('db.operations', 0),
+            'objects_per_second' : objects / wall if wall else 0.0}
+
+def index_one(url):
+    """Index the repo at url from scratch, and return its phase
+    breakdown.  Refuses to touch a repo someone else is indexing."""
+    repo = models.Repository.get_or_create(url=url)
+    if repo.indexing:
+        raise RuntimeError('%s is leased to %s until %s' %
+                           (url, repo.lease_owner, repo.lease_expires))
+    models.flush()
+    stats.reset()
+    start = time.time()
+    fetch.fetch_and_index(repo, recover_mode=True)
+    return _phases(stats.snapshot(), time.time() - start)
+
+def index_many(urls, threads):
+    """Queue up every repo at urls and run index_all over them.  Only
+    the overall time and object count are available, since the work
+    happens in other processes.  Repos someone else is indexing are
+    skipped."""
+    repos = []
+    for url in urls:
+        repo = models.Repository.get_or_create(url=url)
+        if repo.indexing:
+            logger.warning('Skipping %s, which is leased to %s until %s' %
+                           (url, repo.lease_owner, repo.lease_expires))
+            continue
+        repo.approved = True
+        repo.next_index = None
+        repo.save()
+        repos.append(repo)
+    models.flush()
+    start = time.time()
+    fetch.index_all(threads=threads)
+    wall = time.time() - start
+    for repo in repos:
+        repo.refresh()
+    objects = sum(repo.count for repo in repos)
+    return {'wall' : wall,
+            'objects' : objects,
+            'objects_per_second' : objects / wall if wall else 0.0}
+
+def run(workdir=None, scale=1, scenario_names=None, threads=0):
+    """Build the scenarios, serve them, and index each with
+    fetch_and_index.  If threads, also index them all at once with
+    index_all.  Returns results keyed by scenario, plus 'index_all'."""
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='anygit_e2e_')
+    scenario_names = scenario_names or sorted(benchmark.scenarios)
+    results = {}
+    daemon = Daemon(workdir)
+    try:
+        for scenario in scenario_names:
+            logger.info('Building %s (scale %d)' % (scenario, scale))
+            benchmark.make_repo(workdir, scenario, scale)
+        daemon.start()
+        for scenario in scenario_names:
+            results[scenario] = index_one(daemon.url(scenario))
+            logger.info('%s: %.0f objects/s' % (scenario, results[scenario]['objects_per_second']))
+        if threads:
+            results['index_all'] = index_many([daemon.url(scenario) for scenario in scenario_names],
+                                              threads)
+    finally:
+        daemon.stop()
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+def format_results(results):
+    lines = ['%-14s %8s %8s %8s %8s %8s %8s %9s %8s %8s %9s %11s' %
+             ('scenario', 'wall s', 'negot s', 'xfer s', 'parse s', 'proc s', 'flush s',
+              'KB', 'objects', 'edges', 'db ops', 'objects/s')]
+    for scenario, result in sorted(results.iteritems()):
+        if scenario == 'index_all':
+            continue
+        lines.append('%-14s %8.2f %8.2f %8.2f %8.2f %8.2f %8.2f %9d %8d %8d %9d %11.0f' %
+                     (scenario, result['wall'], result['negotiation'], result['transfer'],
+                      result['parse'], result['process'], result['flush'],
+                      result['bytes'] // 1024, result['objects'], result['edges'],
+                      result['db_operations'],
+                      result['objects_per_second']))
+    if 'index_all' in results:
+        result = results['index_all']
+        lines.append('index_all: %d objects in %.2fs (%.0f objects/s)' %
+                     (result['objects'], result['wall'], result['objects_per_second']))
+    return '\n'.join(lines)
@@ -0,0 +1,106 @@
+"""A compact, shareable set of objects that are already fully indexed.
+
+Forks and mirrors share most of their objects with repos we've already
+indexed, and there's no point writing those objects or their edges
+again.  The set is a file of sorted binary sha1s, built offline with
+bin/known_objects and mmapped read-only, so every worker process on a
+machine shares the same pages."""
+import binascii
+import heapq
+import logging
+import mmap
+import os
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+# Number of sha1s to sort in memory at once while building
+build_chunk_size = 1000000
+
+
+class KnownObjects(object):
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        assert not size % 20, '%s is not a known objects file' % path
+        self.count = size // 20
+        if self.count:
+            self._data = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+        else:
+            self._data = ''
+        self._fanout = [self._lower_bound(chr(i)) for i in xrange(256)] + [self.count]
+        logger.info('Loaded %d known objects from %s' % (self.count, path))
+
+    def _lower_bound(self, key, lo=0, hi=None):
+        data = self._data
+        if hi is None:
+            hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if data[mid * 20:mid * 20 + 20] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __contains__(self, sha1):
+        if len(sha1) == 40:
+            sha1 = binascii.unhexlify(sha1)
+        first = ord(sha1[0])
+        i = self._lower_bound(sha1, self._fanout[first], self._fanout[first + 1])
+        return i < self.count and self._data[i * 20:i * 20 + 20] == sha1
+
+    def __len__(self):
+        return self.count
+
+    def close(self):
+        if self.count:
+            self._data.close()
+        self._file.close()
+
+
+def _sorted_chunks(sha1s):
+    """Sort sha1s in chunks, spilling each to a temporary file."""
+    chunk = []
+    for sha1 in sha1s:
+        chunk.append(binascii.unhexlify(sha1))
+        if len(chunk) >= build_chunk_size:
+            yield _spill(chunk)
+            chunk = []
+    if chunk:
+        yield _spill(chunk)
+
+def _spill(chunk):
+    chunk.sort()
+    f = tempfile.TemporaryFile(prefix='known_')
+    f.write(''.join(chunk))
+    f.seek(0)
+    return f
+
+def _read_sha1s(f):
+    while True:
+        sha1 = f.read(20)
+        if not sha1:
+            break
+        yield sha1
+
+def build(path, sha1s):
+    """Write the given hex sha1s out as a known objects file.  The new
+    file replaces any old one atomically."""
+    chunks = list(_sorted_chunks(sha1s))
+    tmp = '%s~' % path
+    out = open(tmp, 'wb')
+    count = 0
+    last = None
+    for sha1 in heapq.merge(*[_read_sha1s(f) for f in chunks]):
+        if sha1 != last:
+            out.write(sha1)
+            count += 1
+            last = sha1
+    out.close()
+    for f in chunks:
+        f.close()
+    os.rename(tmp, path)
+    logger.info('Wrote %d known objects to %s' % (count, path))
+    return count
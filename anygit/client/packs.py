@@ -0,0 +1,688 @@
+"""Reading git pack data directly, without going through dulwich.
+
+PackStream parses a pack as it comes in over the network, so that
+indexing can overlap with the transfer.  PackReader reads a pack that
+is already on disk, using its index."""
+import array
+import bisect
+import collections
+import hashlib
+import itertools
+import logging
+import mmap
+import os
+import Queue
+import struct
+import subprocess
+import tempfile
+import weakref
+import zlib
+
+from anygit import memory
+from anygit.client import git_parser
+
+try:
+    import multiprocessing
+except ImportError:
+    import processing as multiprocessing
+
+logger = logging.getLogger(__name__)
+
+TYPE_NAMES = {1 : 'commit', 2 : 'tree', 3 : 'blob', 4 : 'tag'}
+OFS_DELTA = 6
+REF_DELTA = 7
+
+# Total bytes of inflated objects to keep around as delta bases
+default_cache_size = 64 * 1024 * 1024
+# Network chunks allowed to queue up before the fetch blocks
+max_queued_chunks = 256
+# How much compressed data to hand zlib at a time
+inflate_chunk_size = 4096
+# When reading a pack in parallel, how many pieces to split it into
+# per process, so that the processes finish at about the same time
+chunks_per_process = 4
+
+# The reader being read in parallel, inherited by the pool's processes
+_parallel_reader = None
+# Every DeltaBaseCache in use, for memory accounting
+_caches = weakref.WeakSet()
+
+
+class Error(Exception):
+    pass
+
+
+class UnresolvableDelta(Error):
+    pass
+
+
+def object_sha1(type_name, data):
+    s = hashlib.sha1('%s %d\0' % (type_name, len(data)))
+    s.update(data)
+    return s.digest()
+
+def read_entry_header(buf, pos):
+    """Parse the header of the pack entry at pos.  Returns (type
+    number, inflated size, delta base, position of the compressed
+    data).  The delta base is a negative offset for OFS_DELTA entries
+    and a binary sha1 for REF_DELTA entries.  Raises IndexError if buf
+    is too short."""
+    c = ord(buf[pos])
+    pos += 1
+    type_num = (c >> 4) & 7
+    size = c & 15
+    shift = 4
+    while c & 0x80:
+        c = ord(buf[pos])
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+
+    base = None
+    if type_num == OFS_DELTA:
+        c = ord(buf[pos])
+        pos += 1
+        base = c & 0x7f
+        while c & 0x80:
+            c = ord(buf[pos])
+            pos += 1
+            base = ((base + 1) << 7) | (c & 0x7f)
+    elif type_num == REF_DELTA:
+        base = buf[pos:pos + 20]
+        if len(base) != 20:
+            raise IndexError('Truncated delta base')
+        pos += 20
+    return type_num, size, base, pos
+
+def _delta_size(delta, pos):
+    size = 0
+    shift = 0
+    while True:
+        c = ord(delta[pos])
+        pos += 1
+        size |= (c & 0x7f) << shift
+        shift += 7
+        if not c & 0x80:
+            return size, pos
+
+def apply_delta(base, delta):
+    src_size, pos = _delta_size(delta, 0)
+    dest_size, pos = _delta_size(delta, pos)
+    if src_size != len(base):
+        raise Error('Delta expected a base of %d bytes, got %d' % (src_size, len(base)))
+    out = []
+    end = len(delta)
+    while pos < end:
+        c = ord(delta[pos])
+        pos += 1
+        if c & 0x80:
+            # Copy from the base
+            offset = 0
+            for i in xrange(4):
+                if c & (1 << i):
+                    offset |= ord(delta[pos]) << (8 * i)
+                    pos += 1
+            size = 0
+            for i in xrange(3):
+                if c & (1 << (4 + i)):
+                    size |= ord(delta[pos]) << (8 * i)
+                    pos += 1
+            if not size:
+                size = 0x10000
+            out.append(base[offset:offset + size])
+        elif c:
+            # Insert literal data
+            out.append(delta[pos:pos + c])
+            pos += c
+        else:
+            raise Error('Invalid delta opcode 0')
+    result = ''.join(out)
+    if len(result) != dest_size:
+        raise Error('Delta produced %d bytes, expected %d' % (len(result), dest_size))
+    return result
+
+
+class DeltaBaseCache(object):
+    """An LRU of inflated objects keyed by pack offset, bounded by
+    their total size.  A max_size of None means unbounded."""
+    def __init__(self, max_size=default_cache_size):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._offsets_by_sha1 = {}
+        _caches.add(self)
+
+    def get(self, offset):
+        try:
+            entry = self._entries.pop(offset)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[offset] = entry
+        self.hits += 1
+        return entry[0], entry[1]
+
+    def offset_for_sha1(self, sha1):
+        return self._offsets_by_sha1.get(sha1)
+
+    def add(self, offset, type_num, data, sha1=None):
+        if offset in self._entries:
+            return
+        if self.max_size is not None and len(data) > self.max_size:
+            return
+        self._entries[offset] = (type_num, data, sha1)
+        if sha1 is not None:
+            self._offsets_by_sha1[sha1] = offset
+        self.size += len(data)
+        while self.max_size is not None and self.size > self.max_size:
+            _, (_, evicted, evicted_sha1) = self._entries.popitem(last=False)
+            self.size -= len(evicted)
+            if evicted_sha1 is not None:
+                del self._offsets_by_sha1[evicted_sha1]
+
+
+def _cached_bytes():
+    return sum(cache.size for cache in list(_caches))
+
+memory.register('delta_cache_bytes', _cached_bytes)
+
+
+class PackStream(object):
+    """Parses a pack as it is fed to us, one network chunk at a time.
+
+    feed() and close() are called from the fetching thread, while
+    iterobjects() runs in whichever thread consumes the objects.
+    Unless spool is False, the raw pack is also written to a temporary
+    file, which is used to re-read delta bases that have fallen out of
+    the cache."""
+    def __init__(self, spool=True, cache_size=default_cache_size):
+        self._queue = Queue.Queue(max_queued_chunks)
+        self.failed = False
+        # Whether we've taken close()'s end marker off the queue
+        self._ended = False
+        self.cache = DeltaBaseCache(cache_size)
+        if spool:
+            fd, self.spool_path = tempfile.mkstemp()
+            self._spool = os.fdopen(fd, 'wb')
+        else:
+            self.spool_path = None
+            self._spool = None
+        self._spool_reader = None
+        self._buf = ''
+        self._pos = 0
+        # Absolute offset in the pack of self._buf[self._pos]
+        self._offset = 0
+        self.bytes_received = 0
+        # Maps a binary sha1 to REF_DELTA entries waiting on it
+        self._waiting = {}
+
+    ## Producer side
+
+    def feed(self, data):
+        while not self.failed:
+            try:
+                self._queue.put(data, timeout=1)
+            except Queue.Full:
+                continue
+            else:
+                return
+
+    def close(self):
+        self.feed(None)
+
+    ## Consumer side
+
+    def _more(self):
+        if self._ended:
+            chunk = None
+        else:
+            chunk = self._queue.get()
+        if chunk is None:
+            self._ended = True
+            raise Error('Pack ended early (after %d bytes)' % self.bytes_received)
+        self.bytes_received += len(chunk)
+        if self._spool:
+            self._spool.write(chunk)
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+
+    def _advance(self, n):
+        self._pos += n
+        self._offset += n
+
+    def _read_header(self):
+        while True:
+            try:
+                type_num, size, base, pos = read_entry_header(self._buf, self._pos)
+            except IndexError:
+                self._more()
+            else:
+                self._advance(pos - self._pos)
+                return type_num, size, base
+
+    def _inflate(self, size):
+        d = zlib.decompressobj()
+        out = []
+        while True:
+            if self._pos >= len(self._buf):
+                self._more()
+            piece = buffer(self._buf, self._pos, inflate_chunk_size)
+            out.append(d.decompress(piece))
+            if d.unused_data:
+                self._advance(len(piece) - len(d.unused_data))
+                break
+            self._advance(len(piece))
+        data = ''.join(out)
+        if len(data) != size:
+            raise Error('Inflated %d bytes at offset %d, expected %d' %
+                        (len(data), self._offset, size))
+        return data
+
+    def _read_spooled(self, offset):
+        """Re-read an object we've already streamed past."""
+        if not self._spool:
+            raise UnresolvableDelta('Delta base at offset %d is no longer cached, '
+                                    'and the pack is not being spooled' % offset)
+        self._spool.flush()
+        if not self._spool_reader:
+            self._spool_reader = open(self.spool_path, 'rb')
+        f = self._spool_reader
+        f.seek(offset)
+        buf = f.read(64)
+        type_num, size, base, pos = read_entry_header(buf, 0)
+        f.seek(offset + pos)
+        d = zlib.decompressobj()
+        out = []
+        while not d.unused_data:
+            piece = f.read(inflate_chunk_size)
+            if not piece:
+                break
+            out.append(d.decompress(piece))
+        data = ''.join(out)
+        if type_num == OFS_DELTA:
+            base_type, base_data = self._resolve_offset(offset - base)
+        elif type_num == REF_DELTA:
+            base_type, base_data = self._resolve_sha1(base)
+        else:
+            return type_num, data
+        return base_type, apply_delta(base_data, data)
+
+    def _resolve_offset(self, offset):
+        cached = self.cache.get(offset)
+        if cached is not None:
+            return cached
+        type_num, data = self._read_spooled(offset)
+        self.cache.add(offset, type_num, data)
+        return type_num, data
+
+    def _resolve_sha1(self, sha1):
+        offset = self.cache.offset_for_sha1(sha1)
+        if offset is None:
+            raise UnresolvableDelta('Delta base %s is no longer cached' % sha1.encode('hex'))
+        return self._resolve_offset(offset)
+
+    def _finish(self, offset, type_num, data):
+        """Record a fully resolved object, and return its record along
+        with any that were waiting on it as a delta base."""
+        type_name = TYPE_NAMES[type_num]
+        binary_sha1 = object_sha1(type_name, data)
+        self.cache.add(offset, type_num, data, binary_sha1)
+        objects = [git_parser.make_object(type_name, binary_sha1, data)]
+        for waiting_offset, delta in self._waiting.pop(binary_sha1, []):
+            objects.extend(self._finish(waiting_offset, type_num, apply_delta(data, delta)))
+        return objects
+
+    def iterobjects(self):
+        try:
+            while len(self._buf) < 12:
+                self._more()
+        except Error:
+            if not self.bytes_received:
+                # Nothing to fetch
+                return
+            raise
+        signature, version, count = struct.unpack('>4sLL', self._buf[:12])
+        if signature != 'PACK' or version not in (2, 3):
+            raise Error('Not a pack (signature %r, version %d)' % (signature, version))
+        self._advance(12)
+        logger.debug('Streaming pack with %d objects' % count)
+
+        for _ in xrange(count):
+            offset = self._offset
+            type_num, size, base = self._read_header()
+            data = self._inflate(size)
+            if type_num == OFS_DELTA:
+                base_type, base_data = self._resolve_offset(offset - base)
+                objects = self._finish(offset, base_type, apply_delta(base_data, data))
+            elif type_num == REF_DELTA:
+                base_offset = self.cache.offset_for_sha1(base)
+                if base_offset is None:
+                    # Hopefully its base is still to come
+                    self._waiting.setdefault(base, []).append((offset, data))
+                    continue
+                base_type, base_data = self._resolve_offset(base_offset)
+                objects = self._finish(offset, base_type, apply_delta(base_data, data))
+            else:
+                objects = self._finish(offset, type_num, data)
+            for obj in objects:
+                yield obj
+
+        if self._waiting:
+            raise UnresolvableDelta('%d objects have delta bases missing from the pack' %
+                                    sum(len(v) for v in self._waiting.itervalues()))
+        # Pick up the trailer
+        self.drain()
+
+    def drain(self):
+        """Consume (and spool) whatever else is fed to us, so that the
+        fetching thread never blocks on a consumer that has stopped."""
+        try:
+            while not self._ended:
+                chunk = self._queue.get()
+                if chunk is None:
+                    self._ended = True
+                    break
+                self.bytes_received += len(chunk)
+                if self._spool:
+                    self._spool.write(chunk)
+        except:
+            self.failed = True
+            raise
+        finally:
+            if self._spool_reader:
+                self._spool_reader.close()
+                self._spool_reader = None
+
+    def close_spool(self):
+        if self._spool:
+            self._spool.close()
+
+
+class PackIndex(object):
+    """A version 2 pack index, mmapped."""
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version = struct.unpack('>4sL', self.data[:8])
+        if signature != '\377tOc' or version != 2:
+            raise Error('%s is not a version 2 pack index' % path)
+        self._fanout = struct.unpack('>256L', self.data[8:8 + 256 * 4])
+        self.count = self._fanout[-1]
+        self._sha1s = 8 + 256 * 4
+        self._offsets = self._sha1s + 24 * self.count
+        self._large_offsets = self._offsets + 4 * self.count
+
+    def sha1(self, i):
+        """The binary sha1 of the ith object, in sha1 order."""
+        start = self._sha1s + 20 * i
+        return self.data[start:start + 20]
+
+    def offset(self, i):
+        start = self._offsets + 4 * i
+        offset, = struct.unpack('>L', self.data[start:start + 4])
+        if offset & 0x80000000:
+            start = self._large_offsets + 8 * (offset & 0x7fffffff)
+            offset, = struct.unpack('>Q', self.data[start:start + 8])
+        return offset
+
+    def offset_for_sha1(self, sha1):
+        """The offset of the object with the given binary sha1, or None."""
+        first = ord(sha1[0])
+        lo = first and self._fanout[first - 1]
+        hi = self._fanout[first]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.sha1(mid) < sha1:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.count and self.sha1(lo) == sha1:
+            return self.offset(lo)
+        return None
+
+    def close(self):
+        self.data.close()
+        self._file.close()
+
+
+def build_index(pack_path, index_path):
+    """Have git write an index for a pack."""
+    devnull = open(os.devnull, 'w')
+    try:
+        # index-pack prints the pack's checksum
+        subprocess.check_call([git_parser.GIT_CMD, 'index-pack', '-o', index_path, pack_path],
+                              stdout=devnull)
+    finally:
+        devnull.close()
+
+
+class PackReader(object):
+    """Reads every object out of a pack on disk.  The pack and its
+    index are mmapped, and delta chains are resolved through an LRU of
+    inflated bases, so memory stays bounded however big the pack is.
+    Sha1s come from the index rather than being computed.
+
+    If index_path is None, the index next to the pack is used, or a
+    temporary one is built if there isn't one.  Unless inflate_blobs,
+    blobs are never inflated (except as delta bases), since all we
+    need of them is their sha1 and type, which the index and entry
+    headers give us."""
+    def __init__(self, path, index_path=None, cache_size=default_cache_size,
+                 inflate_blobs=False):
+        self.path = path
+        self.inflate_blobs = inflate_blobs
+        self._temporary_index = None
+        if index_path is None:
+            if path.endswith('.pack') and os.path.exists(path[:-5] + '.idx'):
+                index_path = path[:-5] + '.idx'
+            else:
+                fd, index_path = tempfile.mkstemp(suffix='.idx')
+                os.close(fd)
+                # index-pack won't overwrite
+                os.unlink(index_path)
+                build_index(path, index_path)
+                self._temporary_index = index_path
+        self.index = PackIndex(index_path)
+        self._file = open(path, 'rb')
+        self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        signature, version, count = struct.unpack('>4sLL', self.data[:12])
+        if signature != 'PACK' or version not in (2, 3):
+            raise Error('Not a pack (signature %r, version %d)' % (signature, version))
+        if count != self.index.count:
+            raise Error('Pack has %d objects but its index has %d' % (count, self.index.count))
+        self.cache = DeltaBaseCache(cache_size)
+        # Types and chain roots of delta bases, so chains needn't be
+        # walked repeatedly
+        self._base_types = {}
+        self._base_roots = {}
+        self._load_offsets()
+
+    def _load_offsets(self):
+        """Work out pack order, and which objects are delta bases."""
+        by_offset = sorted((self.index.offset(i), i) for i in xrange(self.index.count))
+        self.offsets = array.array('L', (offset for offset, _ in by_offset))
+        self._order = array.array('L', (i for _, i in by_offset))
+        # Only objects that something is deltified against are worth caching
+        self._bases = set()
+        for offset in self.offsets:
+            type_num, size, base, pos = read_entry_header(self.data, offset)
+            if type_num == OFS_DELTA:
+                self._bases.add(offset - base)
+            elif type_num == REF_DELTA:
+                self._bases.add(self._base_offset(base))
+
+    def _base_offset(self, sha1):
+        offset = self.index.offset_for_sha1(sha1)
+        if offset is None:
+            raise UnresolvableDelta('Delta base %s is not in the pack' % sha1.encode('hex'))
+        return offset
+
+    def _inflate(self, offset, pos, size):
+        # Entries run up to the next one, or to the trailing checksum
+        i = bisect.bisect_right(self.offsets, offset)
+        if i < len(self.offsets):
+            end = self.offsets[i]
+        else:
+            end = len(self.data) - 20
+        data = zlib.decompress(buffer(self.data, pos, end - pos))
+        if len(data) != size:
+            raise Error('Inflated %d bytes at offset %d, expected %d' % (len(data), offset, size))
+        return data
+
+    def type_at(self, offset):
+        """Return the type number of the object at offset, following
+        its delta chain by header alone."""
+        chain = []
+        while True:
+            type_num = self._base_types.get(offset)
+            if type_num is not None:
+                break
+            type_num, size, base, pos = read_entry_header(self.data, offset)
+            if type_num == OFS_DELTA:
+                chain.append(offset)
+                offset -= base
+            elif type_num == REF_DELTA:
+                chain.append(offset)
+                offset = self._base_offset(base)
+            else:
+                if offset in self._bases:
+                    self._base_types[offset] = type_num
+                break
+        for delta_offset in chain:
+            if delta_offset in self._bases:
+                self._base_types[delta_offset] = type_num
+        return type_num
+
+    def root_at(self, offset):
+        """Return the offset of the object at the bottom of the delta
+        chain for the object at offset."""
+        chain = []
+        while True:
+            root = self._base_roots.get(offset)
+            if root is not None:
+                break
+            type_num, size, base, pos = read_entry_header(self.data, offset)
+            if type_num == OFS_DELTA:
+                chain.append(offset)
+                offset -= base
+            elif type_num == REF_DELTA:
+                chain.append(offset)
+                offset = self._base_offset(base)
+            else:
+                root = offset
+                break
+        for delta_offset in chain + [offset]:
+            if delta_offset in self._bases:
+                self._base_roots[delta_offset] = root
+        return root
+
+    def resolve(self, offset):
+        """Return the type number and contents of the object at offset."""
+        chain = []
+        while True:
+            cached = self.cache.get(offset)
+            if cached is not None:
+                type_num, data = cached
+                break
+            type_num, size, base, pos = read_entry_header(self.data, offset)
+            if type_num == OFS_DELTA:
+                chain.append((offset, pos, size))
+                offset -= base
+            elif type_num == REF_DELTA:
+                chain.append((offset, pos, size))
+                offset = self._base_offset(base)
+            else:
+                data = self._inflate(offset, pos, size)
+                if offset in self._bases:
+                    self.cache.add(offset, type_num, data)
+                break
+        for delta_offset, pos, size in reversed(chain):
+            data = apply_delta(data, self._inflate(delta_offset, pos, size))
+            if delta_offset in self._bases:
+                self.cache.add(delta_offset, type_num, data)
+        return type_num, data
+
+    def iterobjects(self):
+        for offset, i in itertools.izip(self.offsets, self._order):
+            yield self.read(offset, i)
+
+    def read(self, offset, i):
+        """Return the record for the object at offset, which is the
+        ith in the index."""
+        sha1 = self.index.sha1(i)
+        if not self.inflate_blobs and TYPE_NAMES[self.type_at(offset)] == 'blob':
+            return git_parser.Blob(sha1)
+        type_num, data = self.resolve(offset)
+        return git_parser.make_object(TYPE_NAMES[type_num], sha1, data)
+
+    def partition(self, count):
+        """Split the objects in the pack into about count lists of
+        (offset, index position) pairs, keeping each delta chain
+        within one list so the lists can be read independently.
+        Returns the objects that needn't be inflated (blobs, unless
+        inflate_blobs) separately."""
+        uninflated = []
+        chains = {}
+        for offset, i in itertools.izip(self.offsets, self._order):
+            if not self.inflate_blobs and TYPE_NAMES[self.type_at(offset)] == 'blob':
+                uninflated.append((offset, i))
+            else:
+                chains.setdefault(self.root_at(offset), []).append((offset, i))
+        total = len(self.offsets) - len(uninflated)
+        target = max(total // count, 1)
+        partitions = []
+        current = []
+        # In pack order, to keep each process's reads close together
+        for root in sorted(chains):
+            current.extend(chains.pop(root))
+            if len(current) >= target:
+                partitions.append(current)
+                current = []
+        if current:
+            partitions.append(current)
+        return uninflated, partitions
+
+    def iterobjects_parallel(self, processes):
+        """Like iterobjects, but resolving and parsing objects across
+        a pool of processes.  Objects don't come out in pack order, but
+        do come out in the same order every time for a given number of
+        processes, so checkpoints can be resumed from."""
+        global _parallel_reader
+        if multiprocessing.current_process().daemon:
+            # Pool workers can't have children of their own
+            logger.warning('Reading %s serially, since we are in a pool worker' % self.path)
+            for obj in self.iterobjects():
+                yield obj
+            return
+        uninflated, partitions = self.partition(processes * chunks_per_process)
+        logger.info('Reading %s in %d pieces across %d processes' %
+                    (self.path, len(partitions), processes))
+        _parallel_reader = self
+        try:
+            pool = multiprocessing.Pool(processes)
+        finally:
+            _parallel_reader = None
+        try:
+            for offset, i in uninflated:
+                yield self.read(offset, i)
+            for records in pool.imap(_read_partition, partitions):
+                for obj in records:
+                    yield obj
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def close(self):
+        self.data.close()
+        self._file.close()
+        self.index.close()
+        if self._temporary_index:
+            os.unlink(self._temporary_index)
+
+
+def _read_partition(partition):
+    return [_parallel_reader.read(offset, i) for offset, i in partition]
@@ -0,0 +1,50 @@
+"""When each repo should next be indexed.
+
+Every repo gets a target interval between indexings, and is due once
+that long has passed since it was last indexed.  Workers take the most
+overdue repos first (see Repository.pop_next), so under load every
+repo falls behind in proportion to its own interval, rather than in
+whatever order a table scan happens to return them.
+
+The interval starts out proportional to how long it has been since the
+repo last changed, so active repos stay fresh while dormant ones back
+off.  Popular repos (by object count) are shortened a little, and
+slow ones are stretched so that no single repo can take up more than
+its share of the workers."""
+import datetime
+import math
+
+# Bounds on the interval between indexings, in seconds
+min_interval = 60 * 60
+max_interval = 14 * 24 * 60 * 60
+# Interval as a fraction of the time since the repo last changed
+change_ratio = 0.5
+# How much popularity shortens the interval, per factor of ten objects
+popularity_weight = 0.1
+# The interval is at least this many times how long indexing took, so
+# a repo uses at most 1/duration_ratio of a worker
+duration_ratio = 20
+# How long to wait before retrying a repo whose indexing failed
+retry_interval = 60 * 60
+
+
+def _seconds(delta):
+    return delta.days * 24 * 60 * 60 + delta.seconds
+
+def interval(repo, now):
+    """Seconds to wait after indexing repo at now before indexing it
+    again."""
+    if repo.last_changed is None:
+        since_change = max_interval
+    else:
+        since_change = max(_seconds(now - repo.last_changed), 0)
+    seconds = change_ratio * since_change
+    seconds /= 1 + popularity_weight * math.log10(1 + (repo.count or 0))
+    seconds = max(seconds, duration_ratio * (repo.index_duration or 0))
+    return min(max(seconds, min_interval), max_interval)
+
+def next_index(repo, now):
+    return now + datetime.timedelta(seconds=interval(repo, now))
+
+def retry_at(now):
+    return now + datetime.timedelta(seconds=retry_interval)
@@ -0,0 +1,199 @@
+"""A compact map from object sha1 to object type.
+
+The indexer needs to know the type of every object it has seen in a
+repository in order to know which kind of edge a tree entry or tag
+represents.  For large repositories a dict of hex strings is far too
+heavy, so we store fixed-width records of (binary sha1, type code)
+in sorted runs, log-structured merge style.  Large runs live in
+mmapped temporary files so that memory stays bounded."""
+import binascii
+import heapq
+import logging
+import mmap
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+TYPE_CODES = {'blob' : 1, 'tree' : 2, 'commit' : 3, 'tag' : 4}
+TYPE_NAMES = dict((code, name) for name, code in TYPE_CODES.iteritems())
+RECORD_SIZE = 21
+
+# Number of entries to accumulate in a dict before sorting them into a run
+default_max_pending = 100000
+# Runs larger than this many bytes are written to disk and mmapped
+default_spill_threshold = 16 * 1024 * 1024
+# Where to put spilled runs.  None means the system default.
+default_spill_dir = None
+
+
+class Run(object):
+    """An immutable, sorted sequence of fixed-width records."""
+    def __init__(self, data, file=None):
+        self.data = data
+        self.file = file
+        self.count = len(data) // RECORD_SIZE
+        self._fanout = [self._lower_bound(chr(i)) for i in xrange(256)] + [self.count]
+
+    def _lower_bound(self, key, lo=0, hi=None):
+        data = self.data
+        if hi is None:
+            hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = mid * RECORD_SIZE
+            if data[offset:offset + 20] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, key):
+        first = ord(key[0])
+        i = self._lower_bound(key, self._fanout[first], self._fanout[first + 1])
+        offset = i * RECORD_SIZE
+        if i < self.count and self.data[offset:offset + 20] == key:
+            return ord(self.data[offset + 20])
+        return None
+
+    def records(self):
+        data = self.data
+        for offset in xrange(0, self.count * RECORD_SIZE, RECORD_SIZE):
+            yield data[offset:offset + RECORD_SIZE]
+
+    @property
+    def resident_size(self):
+        if self.file is None:
+            return len(self.data)
+        return 0
+
+    def close(self):
+        if self.file is not None:
+            self.data.close()
+            self.file.close()
+
+
+class ObjectTypeMap(object):
+    """Maps sha1s (hex or binary) to type names.  Later assignments
+    to the same sha1 win."""
+    def __init__(self, max_pending=None, spill_threshold=None, spill_dir=None):
+        self.max_pending = max_pending or default_max_pending
+        self.spill_threshold = spill_threshold or default_spill_threshold
+        self.spill_dir = spill_dir or default_spill_dir
+        self._pending = {}
+        # Oldest first
+        self._runs = []
+        self._count = 0
+
+    @staticmethod
+    def _key(sha1):
+        if len(sha1) == 40:
+            return binascii.unhexlify(sha1)
+        assert len(sha1) == 20
+        return sha1
+
+    def _lookup(self, key):
+        code = self._pending.get(key)
+        if code is not None:
+            return code
+        for run in reversed(self._runs):
+            code = run.get(key)
+            if code is not None:
+                return code
+        return None
+
+    def get(self, sha1, default=None):
+        code = self._lookup(self._key(sha1))
+        if code is None:
+            return default
+        return TYPE_NAMES[code]
+
+    def __getitem__(self, sha1):
+        type = self.get(sha1)
+        if type is None:
+            raise KeyError(sha1)
+        return type
+
+    def __contains__(self, sha1):
+        return self._lookup(self._key(sha1)) is not None
+
+    def __setitem__(self, sha1, type):
+        self._pending[self._key(sha1)] = TYPE_CODES[type]
+        self._count += 1
+        if len(self._pending) >= self.max_pending:
+            self._compact()
+
+    def setdefault(self, sha1, type):
+        existing = self.get(sha1)
+        if existing is None:
+            self[sha1] = type
+            return type
+        return existing
+
+    def __len__(self):
+        """The number of assignments made.  Reassigning a sha1
+        counts twice."""
+        return self._count
+
+    def memory_usage(self):
+        """Rough count of bytes held in memory (not counting mmapped runs)."""
+        # A dict entry plus a 20-byte str is about 100 bytes on 64-bit.
+        return (100 * len(self._pending) +
+                sum(run.resident_size for run in self._runs))
+
+    def _compact(self):
+        records = [key + chr(code) for key, code in sorted(self._pending.iteritems())]
+        self._pending.clear()
+        self._runs.append(self._make_run(records, len(records)))
+        # Keep run sizes roughly geometric, so each record is merged
+        # O(log n) times and lookups check O(log n) runs.
+        while len(self._runs) > 1 and self._runs[-2].count <= 2 * self._runs[-1].count:
+            newer = self._runs.pop()
+            older = self._runs.pop()
+            merged = self._make_run(self._merge(older, newer), older.count + newer.count)
+            older.close()
+            newer.close()
+            self._runs.append(merged)
+
+    @staticmethod
+    def _merge(older, newer):
+        def tagged(run, rank):
+            for record in run.records():
+                yield record[:20], rank, record
+        last_key = None
+        for key, rank, record in heapq.merge(tagged(newer, 0), tagged(older, 1)):
+            # The newer run sorts first for equal keys, so drop later duplicates
+            if key != last_key:
+                last_key = key
+                yield record
+
+    def _make_run(self, records, max_count):
+        """Build a run from sorted records, spilling it to disk if it
+        might be large."""
+        if max_count * RECORD_SIZE < self.spill_threshold:
+            return Run(''.join(records))
+        return self._spill_run(records)
+
+    def spill(self):
+        """Move everything held in memory to disk, to free memory."""
+        if self._pending:
+            self._compact()
+        for i, run in enumerate(self._runs):
+            if run.resident_size:
+                self._runs[i] = self._spill_run(run.records())
+                run.close()
+
+    def _spill_run(self, records):
+        file = tempfile.TemporaryFile(prefix='typemap_', dir=self.spill_dir)
+        size = 0
+        for record in records:
+            file.write(record)
+            size += RECORD_SIZE
+        file.flush()
+        logger.debug('Spilled %d type map entries to disk' % (size // RECORD_SIZE))
+        return Run(mmap.mmap(file.fileno(), size, access=mmap.ACCESS_READ), file=file)
+
+    def close(self):
+        self._pending.clear()
+        for run in self._runs:
+            run.close()
+        self._runs = []
@@ -0,0 +1,124 @@
+"""Memory accounting for the indexer.
+
+Off unless enabled is set.  The structures that grow with the size of
+a pack (the type map, pending saves, the delta base caches) register
+a function giving their current size, and optionally one that frees
+what it can.  Every sample_interval objects and before every flush,
+each is sampled along with the process' RSS, and the peaks for the
+repo being indexed are logged once it's done.
+
+If soft_limit is set and RSS goes over it, everything that can free
+memory is asked to, so that we flush or spill to disk early rather
+than being killed."""
+import contextlib
+import logging
+import os
+import resource
+import threading
+
+logger = logging.getLogger(__name__)
+
+enabled = False
+# Objects to index between samples
+sample_interval = 10000
+# Bytes of RSS above which to flush and spill early.  None for no limit.
+soft_limit = None
+
+# name -> (size function, relieve function or None)
+_sources = {}
+# name -> largest size seen for the repo being indexed
+_peaks = {}
+_lock = threading.Lock()
+# Set while relieving, since that may flush, which samples
+_relieving = False
+# Whether we've said we're over the limit for the repo being indexed
+_warned = False
+_page_size = os.sysconf('SC_PAGE_SIZE')
+
+
+def register(name, size, relieve=None):
+    """Sample size() as name.  If given, relieve() is called to free
+    memory when over the soft limit."""
+    _sources[name] = (size, relieve)
+
+def unregister(name):
+    _sources.pop(name, None)
+
+def rss():
+    """The process' resident set size in bytes."""
+    try:
+        f = open('/proc/self/statm')
+    except IOError:
+        # Not Linux, so settle for the peak.  ru_maxrss is in kilobytes.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    try:
+        return int(f.read().split()[1]) * _page_size
+    finally:
+        f.close()
+
+def sample(relieve_pressure=True):
+    """Record the size of everything registered, and unless told not
+    to, relieve memory pressure if over the soft limit.  Returns the
+    sizes, or None if accounting is off."""
+    if not enabled:
+        return None
+    sizes = dict((name, size()) for name, (size, _) in _sources.items())
+    sizes['rss'] = rss()
+    with _lock:
+        for name, value in sizes.iteritems():
+            if value > _peaks.get(name, 0):
+                _peaks[name] = value
+    if (relieve_pressure and soft_limit is not None and sizes['rss'] > soft_limit
+        and not _relieving):
+        relieve(sizes)
+    return sizes
+
+def relieve(sizes=None):
+    """Ask everything registered to free what memory it can."""
+    global _relieving, _warned
+    _relieving = True
+    try:
+        if _warned:
+            log = logger.debug
+        else:
+            log = logger.warning
+            _warned = True
+        log('RSS is over the soft limit of %s (%s); flushing and spilling early' %
+            (_format(soft_limit), _describe(sizes or {})))
+        for name, (_, relieve) in _sources.items():
+            if relieve is not None:
+                relieve()
+    finally:
+        _relieving = False
+
+@contextlib.contextmanager
+def track(repo):
+    """Log the peak sizes seen while indexing repo."""
+    global _warned
+    if not enabled:
+        yield
+        return
+    with _lock:
+        _peaks.clear()
+    _warned = False
+    try:
+        yield
+    finally:
+        sample(relieve_pressure=False)
+        with _lock:
+            peaks = dict(_peaks)
+        logger.info('Memory peaks for %s: %s' % (repo, _describe(peaks)))
+
+def _format(bytes):
+    return '%.1fMB' % (bytes / (1024.0 * 1024))
+
+def _describe(sizes):
+    # RSS first, then whatever else by name.  Byte counts end in
+    # _bytes; everything else is a count of entries.
+    parts = []
+    for name, value in sorted(sizes.iteritems(), key=lambda item: (item[0] != 'rss', item[0])):
+        if name == 'rss' or name.endswith('_bytes'):
+            parts.append('%s=%s' % (name, _format(value)))
+        else:
+            parts.append('%s=%d' % (name, value))
+    return ' '.join(parts)
@@ -6,7 +6,8 @@ from anygit.backends import common
 # Top level names to import
 __BACKEND_VARS = ['create_schema',
                   'setup',
-                  'destroy_session']
+                  'destroy_session',
+                  'ingest']
 
 __COMMON_VARS = ['flush',
                  'GitObject',
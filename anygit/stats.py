@@ -0,0 +1,213 @@
+"""Counters and timers for the indexer.
+
+Each stage of indexing records how long it took and how much it did
+here, so that benchmarks and dashboards can see where the time goes.
+Everything is per process, so each worker has its own figures.
+
+Timers nest: time spent in a timer started inside another (say, a
+flush in the middle of processing a pack) is counted in both totals,
+but is excluded from the outer timer's own time.
+
+Inside a repo() block, everything recorded by that thread is also
+counted against the repo.  Figures are kept for the most recent
+max_repos repos.  write_prometheus exports the lot in Prometheus'
+text format, for node_exporter's textfile collector to pick up."""
+import contextlib
+import os
+import re
+import tempfile
+import threading
+import time
+
+# How many repos to keep separate figures for
+max_repos = 100
+# Prefix for exported metric names
+prefix = 'anygit'
+
+_lock = threading.Lock()
+# (name, repo) -> value.  repo is None for the process wide total.
+_counters = {}
+# (name, repo) -> [number of times timed, total seconds, own seconds]
+_timers = {}
+# Repos with figures, least recently used first
+_repos = []
+# Per thread stack of [seconds spent in nested timers] for open
+# timers, and the repo being worked on
+_local = threading.local()
+
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+def _keys(name):
+    repo = current_repo()
+    if repo is None:
+        return ((name, None),)
+    return ((name, None), (name, repo))
+
+def incr(name, value=1):
+    keys = _keys(name)
+    with _lock:
+        for key in keys:
+            _counters[key] = _counters.get(key, 0) + value
+
+def record_time(name, seconds, own_seconds=None):
+    if own_seconds is None:
+        own_seconds = seconds
+    stack = _stack()
+    if stack:
+        stack[-1][0] += seconds
+    keys = _keys(name)
+    with _lock:
+        for key in keys:
+            timer = _timers.setdefault(key, [0, 0.0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] += own_seconds
+
+@contextlib.contextmanager
+def timer(name):
+    stack = _stack()
+    nested = [0.0]
+    stack.append(nested)
+    start = time.time()
+    try:
+        yield
+    finally:
+        elapsed = time.time() - start
+        stack.pop()
+        record_time(name, elapsed, elapsed - nested[0])
+
+def timed(name, iterable):
+    """Iterate over iterable, recording the time spent waiting on it
+    under name.  The time is recorded once, when iteration stops."""
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.time()
+            try:
+                item = iterator.next()
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.time() - start
+            yield item
+    finally:
+        record_time(name, elapsed)
+
+@contextlib.contextmanager
+def repo(name):
+    """Count everything this thread records against the repo name, as
+    well as the process wide total.  A name of None counts only the
+    total."""
+    if name is not None:
+        with _lock:
+            if name in _repos:
+                _repos.remove(name)
+            _repos.append(name)
+            while len(_repos) > max_repos:
+                _forget(_repos.pop(0))
+    previous = getattr(_local, 'repo', None)
+    _local.repo = name
+    try:
+        yield
+    finally:
+        _local.repo = previous
+
+def current_repo():
+    """The repo this thread is recording against, or None."""
+    return getattr(_local, 'repo', None)
+
+def _forget(repo):
+    for series in (_counters, _timers):
+        for key in [key for key in series if key[1] == repo]:
+            del series[key]
+
+def snapshot(repo=None):
+    """Return a copy of the counters and timers for repo, or the
+    process wide totals, as
+    {'counters' : {name : value},
+     'timers' : {name : (count, seconds, own seconds)}}"""
+    with _lock:
+        return {'counters' : dict((name, value) for (name, r), value in _counters.iteritems()
+                                  if r == repo),
+                'timers' : dict((name, tuple(timer)) for (name, r), timer in _timers.iteritems()
+                                if r == repo)}
+
+def seconds(snapshot, name, own=False):
+    count, total, own_seconds = snapshot['timers'].get(name, (0, 0.0, 0.0))
+    if own:
+        return own_seconds
+    return total
+
+def summary(snapshot):
+    """A one line summary of a snapshot, for the logs."""
+    parts = ['%s=%d' % item for item in sorted(snapshot['counters'].iteritems())]
+    parts.extend('%s=%.2fs/%d' % (name, timer[1], timer[0])
+                 for name, timer in sorted(snapshot['timers'].iteritems()))
+    return ' '.join(parts)
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+        del _repos[:]
+
+
+## Export
+
+def _metric_name(name):
+    return '%s_%s' % (prefix, re.sub('[^a-zA-Z0-9_]', '_', name))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels, repo):
+    if repo is not None:
+        labels = labels + [('repo', repo)]
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(value)) for key, value in labels)
+
+def format_prometheus(**labels):
+    """Return every counter and timer in Prometheus' text format, with
+    labels added to each series.  Timers become _seconds_total,
+    _own_seconds_total and _count series."""
+    labels = sorted(labels.iteritems())
+    with _lock:
+        counters = sorted(_counters.iteritems())
+        timers = sorted((key, tuple(timer)) for key, timer in _timers.iteritems())
+    lines = []
+    last = None
+    for (name, repo), value in counters:
+        metric = _metric_name(name) + '_total'
+        if metric != last:
+            lines.append('# TYPE %s counter' % metric)
+            last = metric
+        lines.append('%s%s %d' % (metric, _labels(labels, repo), value))
+    for suffix, index in (('_seconds_total', 1), ('_own_seconds_total', 2), ('_count', 0)):
+        last = None
+        for (name, repo), timer in timers:
+            metric = _metric_name(name) + suffix
+            if metric != last:
+                lines.append('# TYPE %s counter' % metric)
+                last = metric
+            lines.append('%s%s %s' % (metric, _labels(labels, repo), timer[index]))
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(path, **labels):
+    """Atomically write format_prometheus(**labels) to path."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.stats_')
+    f = os.fdopen(fd, 'w')
+    try:
+        f.write(format_prometheus(**labels))
+    finally:
+        f.close()
+    os.chmod(tmp_path, 0644)
+    os.rename(tmp_path, path)
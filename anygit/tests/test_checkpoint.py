@@ -0,0 +1,109 @@
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from anygit.client import fetch
+
+
+class FakeRepository(object):
+    def __init__(self, id='repo', last_index=None):
+        self.id = id
+        self.last_index = last_index
+
+    def __str__(self):
+        return self.id
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='anygit_test_')
+        self.old_checkpoint_dir = fetch.checkpoint_dir
+        self.old_read_processes = fetch.read_processes
+        fetch.checkpoint_dir = os.path.join(self.workdir, 'checkpoints')
+        self.repo = FakeRepository()
+
+    def tearDown(self):
+        fetch.checkpoint_dir = self.old_checkpoint_dir
+        fetch.read_processes = self.old_read_processes
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _make_pack(self, name):
+        path = os.path.join(self.workdir, name)
+        open(path, 'w').close()
+        return path
+
+    def _checkpoint(self, repo=None):
+        """Write a checkpoint part way through the second of two packs,
+        and return the pack paths."""
+        fetch.read_processes = 4
+        checkpoint = fetch.Checkpoint(repo or self.repo, {'retrieved' : set(['a' * 40])})
+        packs = [self._make_pack('1.pack'), self._make_pack('2.pack')]
+        for path in packs:
+            checkpoint.start_pack(path)
+        checkpoint.count = 500
+        checkpoint.phase = 'deferred'
+        checkpoint.save()
+        return packs
+
+    def test_resume(self):
+        packs = self._checkpoint()
+        # Resumed by a run with different settings
+        fetch.read_processes = 1
+        state = {}
+        checkpoint = fetch.Checkpoint(self.repo, state)
+        self.assertTrue(checkpoint.load())
+        self.assertEqual(checkpoint.packs, packs)
+        self.assertEqual(checkpoint.count, 500)
+        self.assertEqual(checkpoint.phase, 'deferred')
+        self.assertEqual(checkpoint.read_processes, 4)
+        self.assertEqual(state['retrieved'], set(['a' * 40]))
+
+    def test_no_checkpoint(self):
+        self.assertFalse(fetch.Checkpoint(self.repo, {}).load())
+
+    def test_discard(self):
+        packs = self._checkpoint()
+        checkpoint = fetch.Checkpoint(self.repo, {})
+        checkpoint.load()
+        checkpoint.discard()
+        for path in packs + [checkpoint.path]:
+            self.assertFalse(os.path.exists(path))
+        self.assertFalse(fetch.Checkpoint(self.repo, {}).load())
+
+    def test_missing_pack(self):
+        packs = self._checkpoint()
+        os.unlink(packs[0])
+        self.assertFalse(fetch.Checkpoint(self.repo, {}).load())
+        self.assertFalse(os.path.exists(packs[1]))
+
+    def test_stale(self):
+        packs = self._checkpoint()
+        checkpoint = fetch.Checkpoint(self.repo, {})
+        f = open(checkpoint.path)
+        data = json.load(f)
+        f.close()
+        data['written'] -= fetch.checkpoint_max_age + 1
+        f = open(checkpoint.path, 'w')
+        json.dump(data, f)
+        f.close()
+        self.assertFalse(checkpoint.load())
+        for path in packs:
+            self.assertFalse(os.path.exists(path))
+
+    def test_indexed_since(self):
+        self._checkpoint()
+        self.repo.last_index = datetime.datetime.now() + datetime.timedelta(seconds=60)
+        self.assertFalse(fetch.Checkpoint(self.repo, {}).load())
+
+    def test_sweep(self):
+        packs = self._checkpoint()
+        path = fetch.Checkpoint(self.repo, {}).path
+        old = time.time() - fetch.checkpoint_max_age - 1
+        os.utime(path, (old, old))
+        fetch.sweep_checkpoints()
+        for path in packs + [path]:
+            self.assertFalse(os.path.exists(path))
@@ -0,0 +1,87 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from anygit.client import git_parser, packs
+
+
+def make_pack(workdir, commits=300):
+    """Build a bare repo under workdir with a line of small commits,
+    fully packed, and return the path of its pack."""
+    repo = os.path.join(workdir, 'repo.git')
+    subprocess.check_call([git_parser.GIT_CMD, 'init', '--quiet', '--bare', repo])
+    importer = subprocess.Popen([git_parser.GIT_CMD, 'fast-import', '--quiet'],
+                                cwd=repo, stdin=subprocess.PIPE)
+    for commit in xrange(commits):
+        contents = 'line %d\n' % commit
+        message = 'Commit %d' % commit
+        importer.stdin.write('blob\nmark :%d\ndata %d\n%s\n' %
+                             (2 * commit + 1, len(contents), contents))
+        importer.stdin.write('commit refs/heads/master\nmark :%d\n'
+                             'committer Test <test@example.com> %d +0000\n'
+                             'data %d\n%s\n' %
+                             (2 * commit + 2, 1000000000 + commit, len(message), message))
+        if commit:
+            importer.stdin.write('from :%d\n' % (2 * commit))
+        importer.stdin.write('M 100644 :%d file%d.txt\n\n' % (2 * commit + 1, commit % 10))
+    importer.stdin.close()
+    if importer.wait():
+        raise subprocess.CalledProcessError(importer.returncode, 'git fast-import')
+    subprocess.check_call([git_parser.GIT_CMD, 'repack', '-a', '-d', '-q'], cwd=repo)
+    pack_dir = os.path.join(repo, 'objects', 'pack')
+    name, = [name for name in os.listdir(pack_dir) if name.endswith('.pack')]
+    return os.path.join(pack_dir, name)
+
+
+class TestPackStream(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='anygit_test_')
+        pack_path = make_pack(self.workdir)
+        f = open(pack_path, 'rb')
+        try:
+            self.pack = f.read()
+        finally:
+            f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def _consume(self, stream):
+        """Index stream in a thread the way StreamIndexer does, draining
+        it on error.  Returns the thread and a list that gets the
+        error."""
+        errors = []
+        def run():
+            try:
+                for _ in stream.iterobjects():
+                    pass
+            except packs.Error, e:
+                errors.append(e)
+                stream.drain()
+        consumer = threading.Thread(target=run)
+        consumer.daemon = True
+        consumer.start()
+        return consumer, errors
+
+    def test_fetch_fails_mid_stream(self):
+        # The fetch dies after half the pack, so stream_and_index
+        # closes the stream and waits for the indexer
+        stream = packs.PackStream(spool=False)
+        consumer, errors = self._consume(stream)
+        stream.feed(self.pack[:len(self.pack) // 2])
+        stream.close()
+        consumer.join(10)
+        self.assertFalse(consumer.isAlive(), 'indexer hung draining a closed stream')
+        self.assertEqual(len(errors), 1)
+
+    def test_complete_stream(self):
+        stream = packs.PackStream(spool=False)
+        consumer, errors = self._consume(stream)
+        stream.feed(self.pack)
+        stream.close()
+        consumer.join(10)
+        self.assertFalse(consumer.isAlive())
+        self.assertEqual(errors, [])
@@ -0,0 +1,65 @@
+import hashlib
+import unittest
+
+from anygit.client import type_map
+
+
+def sha1(i):
+    return hashlib.sha1(str(i)).hexdigest()
+
+TYPES = ['blob', 'tree', 'commit', 'tag']
+
+
+class TestObjectTypeMap(unittest.TestCase):
+    def setUp(self):
+        # Small enough that a few hundred assignments make several runs
+        # and merges, and every merged run goes to disk
+        self.map = type_map.ObjectTypeMap(max_pending=10, spill_threshold=30 * type_map.RECORD_SIZE)
+
+    def tearDown(self):
+        self.map.close()
+
+    def test_lookup_across_runs(self):
+        for i in xrange(500):
+            self.map[sha1(i)] = TYPES[i % 4]
+        self.assertTrue(len(self.map._runs) > 1)
+        self.assertTrue(any(run.file is not None for run in self.map._runs))
+        for i in xrange(500):
+            self.assertEqual(self.map[sha1(i)], TYPES[i % 4])
+        self.assertEqual(self.map.get(sha1(500)), None)
+        self.assertFalse(sha1(500) in self.map)
+        self.assertRaises(KeyError, self.map.__getitem__, sha1(500))
+
+    def test_binary_keys(self):
+        self.map[sha1(1)] = 'tree'
+        self.assertEqual(self.map[sha1(1).decode('hex')], 'tree')
+
+    def test_later_assignments_win(self):
+        for i in xrange(200):
+            self.map[sha1(i)] = 'blob'
+        for i in xrange(0, 200, 3):
+            self.map[sha1(i)] = 'tree'
+        self.map.spill()
+        for i in xrange(200):
+            if i % 3:
+                self.assertEqual(self.map[sha1(i)], 'blob')
+            else:
+                self.assertEqual(self.map[sha1(i)], 'tree')
+
+    def test_spill(self):
+        map = type_map.ObjectTypeMap(max_pending=1000)
+        try:
+            for i in xrange(100):
+                map[sha1(i)] = TYPES[i % 4]
+            self.assertTrue(map.memory_usage() > 0)
+            map.spill()
+            self.assertEqual(map.memory_usage(), 0)
+            for i in xrange(100):
+                self.assertEqual(map[sha1(i)], TYPES[i % 4])
+        finally:
+            map.close()
+
+    def test_setdefault(self):
+        self.assertEqual(self.map.setdefault(sha1(1), 'commit'), 'commit')
+        self.assertEqual(self.map.setdefault(sha1(1), 'blob'), 'commit')
+        self.assertEqual(len(self.map), 1)
@@ -0,0 +1,60 @@
+import threading
+import unittest
+
+from anygit.backends import common
+
+
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.writer = common.WriteBehind()
+        self.written = []
+        self.failing = set()
+        # Holds up the first write, so the rest queue up behind it
+        self.gate = threading.Event()
+
+    def tearDown(self):
+        self.gate.set()
+
+    def write(self, batch):
+        if batch == 1:
+            self.gate.wait(10)
+        if batch in self.failing:
+            raise IOError('database went away')
+        self.written.append(batch)
+
+    def test_writes_in_order(self):
+        self.gate.set()
+        for batch in xrange(1, 6):
+            self.writer.submit(self.write, batch)
+        self.writer.wait()
+        self.assertEqual(self.written, [1, 2, 3, 4, 5])
+        self.assertEqual(self.writer.pending(), 0)
+
+    def test_failed_batches_are_retried_in_order(self):
+        self.failing.add(2)
+        self.writer.submit(self.write, 1)
+        self.writer.submit(self.write, 2)
+        self.writer.submit(self.write, 3)
+        self.gate.set()
+        self.assertRaises(IOError, self.writer.wait)
+        # The failed batch and the one behind it are held, not dropped
+        self.assertEqual(self.written, [1])
+        self.assertEqual(self.writer.pending(), 2)
+
+        self.failing.clear()
+        self.writer.submit(self.write, 4)
+        self.writer.wait()
+        self.assertEqual(self.written, [1, 2, 3, 4])
+        self.assertEqual(self.writer.pending(), 0)
+
+    def test_failed_retry_is_held_again(self):
+        self.failing.add(1)
+        self.gate.set()
+        self.writer.submit(self.write, 1)
+        self.assertRaises(IOError, self.writer.wait)
+        self.assertRaises(IOError, self.writer.wait)
+        self.assertEqual(self.writer.pending(), 1)
+
+        self.failing.clear()
+        self.writer.wait()
+        self.assertEqual(self.written, [1])
@@ -97,13 +97,19 @@ CREATE TABLE `repositories` (
   `url` varchar(3000) COLLATE utf8_bin NOT NULL,
   `been_indexed` tinyint(1) NOT NULL DEFAULT 0,
   `last_index` datetime,
-  `indexing` tinyint(1) NOT NULL DEFAULT 0,
+  `lease_owner` varchar(255) DEFAULT NULL,
+  `lease_expires` datetime DEFAULT NULL,
+  `next_index` datetime DEFAULT NULL,
+  `last_changed` datetime DEFAULT NULL,
+  `index_duration` float NOT NULL DEFAULT 0,
   `approved` varchar(20) NOT NULL DEFAULT 'spidered',
   `count` int(11) NOT NULL DEFAULT 0,
   `dirty` tinyint(1) NOT NULL DEFAULT 0,
   `_remote_heads` MEDIUMTEXT,
   `_new_remote_heads` MEDIUMTEXT,
-  PRIMARY KEY (`id`)
+  PRIMARY KEY (`id`),
+  KEY `lease_expires` (`lease_expires`),
+  KEY `next_index` (`next_index`)
 ) ENGINE=MyISAM DEFAULT CHARSET=utf8 COLLATE=utf8_bin;
 
 